@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+arrow_merge.py : Detection and merging of near-duplicate arrows
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module groups arrows whose ends lie within a physical radius of each
+    other and whose directions differ by less than an angular tolerance, and
+    collapses every group into one arrow (mean end, normalized mean direction
+    scaled to the mean length). Candidate pairs come from a vectorized grid
+    hash and groups from label propagation, so there is no per-arrow Python
+    loop. It works on arrow columns, on one arrow JSON file or on every JSON
+    file of a folder, and can be run from the command line.
+"""
+
+import json
+import os
+
+import numpy as np
+from folder_index import TIFF_EXTENSIONS
+
+# 3x3x3 邻域中的本格和“正向”的 13 个邻格：每对相邻格子只比较一次
+_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), axis=-1).reshape(-1, 3)[13:]
+
+
+def candidate_pairs(points, radius):
+    """
+    All pairs (i, j), i < j, of points closer than radius, found by hashing the
+    points into cells of edge radius and comparing neighbouring cells only
+    :return: two int arrays i, j
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    n = len(points)
+    if n < 2 or radius <= 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    cells = np.floor((points - points.min(axis=0)) / radius).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    pairs_i, pairs_j = [], []
+    for offset in _OFFSETS:
+        code = (offset[0] * dims[1] + offset[1]) * dims[2] + offset[2]
+        # 按排好序的键查找，searchsorted 的访存是顺序的
+        left = np.searchsorted(sorted_keys, sorted_keys + code, side='left')
+        counts = np.searchsorted(sorted_keys, sorted_keys + code, side='right') - left
+        total = counts.sum()
+        if not total:
+            continue
+        # 把每个点对应的 [left, left + count) 区间展开成一维
+        i = np.repeat(np.arange(n), counts)
+        j = np.arange(total) + np.repeat(left - np.cumsum(counts) + counts, counts)
+        if code == 0:
+            keep = i < j
+            i, j = i[keep], j[keep]
+        pairs_i.append(order[i])
+        pairs_j.append(order[j])
+    if not pairs_i:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    close = np.einsum('ij,ij->i', points[i] - points[j], points[i] - points[j]) <= radius * radius
+    return i[close], j[close]
+
+
+def connected_labels(n, i, j):
+    """
+    Connected components of the graph with n nodes and edges (i, j), by
+    min-label propagation with pointer jumping
+    :return: (n,) labels, each the smallest node index of its component
+    """
+    labels = np.arange(n)
+    if not len(i):
+        return labels
+    while True:
+        old = labels.copy()
+        low = np.minimum(labels[i], labels[j])
+        np.minimum.at(labels, i, low)
+        np.minimum.at(labels, j, low)
+        labels = labels[labels]
+        if np.array_equal(labels, old):
+            return labels
+
+
+def cluster_arrows(ends, directions, radius, max_angle):
+    """
+    :param radius: largest distance between the ends of two duplicates (physical units)
+    :param max_angle: largest angle between the directions of two duplicates (degrees)
+    :return: (N,) cluster labels, each the lowest row of its cluster
+    """
+    ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+    i, j = candidate_pairs(ends, radius)
+    units = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    aligned = np.einsum('ij,ij->i', units[i], units[j]) >= np.cos(np.radians(max_angle))
+    return connected_labels(len(ends), i[aligned], j[aligned])
+
+
+def merge_clusters(ends, directions, labels):
+    """
+    Collapse every cluster to one arrow
+    :return: rows kept (the lowest row of each cluster, in order), and their
+        merged ends and directions
+    """
+    ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+    keep, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    lengths = np.linalg.norm(directions, axis=1)
+    sums = np.zeros((len(keep), 3))
+    np.add.at(sums, inverse, ends)
+    merged_ends = sums / counts[:, None]
+    unit_sums = np.zeros((len(keep), 3))
+    np.add.at(unit_sums, inverse, directions / lengths[:, None])
+    mean_lengths = np.bincount(inverse, weights=lengths) / counts
+    norms = np.linalg.norm(unit_sums, axis=1)
+    # 方向正好相互抵消时保留代表箭头原来的方向
+    fallback = norms < 1e-9
+    norms[fallback] = 1
+    merged_units = unit_sums / norms[:, None]
+    merged_units[fallback] = directions[keep[fallback]] / lengths[keep[fallback], None]
+    return keep, merged_ends, merged_units * mean_lengths[:, None]
+
+
+def duplicate_groups(labels):
+    """:return: list of the row lists of clusters with more than one arrow"""
+    order = np.argsort(labels, kind='stable')
+    _, first, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    return [order[f:f + c].tolist() for f, c in zip(first, counts) if c > 1]
+
+
+def merge_records(records, radius, max_angle):
+    """
+    Merge near-duplicate arrows given as JSON-style dicts (see
+    ArrowManager.save_to_file); a merged arrow keeps the colour, width and
+    opacity of the first arrow of its cluster
+    :return: merged records, list of merged groups (indices into records)
+    """
+    if not records:
+        return list(records), []
+    ends = np.array([item['end'] for item in records], dtype=float)
+    directions = np.array([item['direction'] for item in records], dtype=float)
+    labels = cluster_arrows(ends, directions, radius, max_angle)
+    groups = duplicate_groups(labels)
+    if not groups:
+        return list(records), []
+    keep, merged_ends, merged_directions = merge_clusters(ends, directions, labels)
+    merged = []
+    for row, end, direction in zip(keep.tolist(), merged_ends.tolist(), merged_directions.tolist()):
+        item = dict(records[row])
+        item['end'] = end
+        item['direction'] = direction
+        item['length'] = float(np.linalg.norm(direction))
+        merged.append(item)
+    return merged, groups
+
+
+def merge_arrow_file(path, radius, max_angle, dry_run=False):
+    """
+    Merge the near-duplicate arrows of one JSON file in place
+    :return: report dict with the file, arrow counts before and after, and the merged groups
+    """
+    from vector_arrow import read_arrow_file
+    records = read_arrow_file(path)
+    merged, groups = merge_records(records, radius, max_angle)
+    if groups and not dry_run:
+        with open(path, 'w') as f:
+            json.dump(merged, f, indent=2)
+    return {'file': path, 'before': len(records), 'after': len(merged), 'groups': groups}
+
+
+def merge_folder(folder_path, radius, max_angle, dry_run=False):
+    """
+    :return: one merge_arrow_file report per arrow JSON file of the folder,
+        i.e. per JSON file next to a TIFF stack of the same name
+    """
+    paths = []
+    for name in sorted(os.listdir(folder_path)):
+        stem, ext = os.path.splitext(name)
+        path = os.path.join(folder_path, stem + '.json')
+        if ext.lower() in TIFF_EXTENSIONS and os.path.exists(path):
+            paths.append(path)
+    return [merge_arrow_file(path, radius, max_angle, dry_run) for path in paths]
+
+
+def format_report(reports):
+    lines = []
+    for report in reports:
+        if report['groups']:
+            groups = ', '.join('+'.join(str(r + 1) for r in group) for group in report['groups'])
+            lines.append(f"{os.path.basename(report['file'])}: {report['before']} -> "
+                         f"{report['after']} arrows (merged {groups})")
+    merged = sum(report['before'] - report['after'] for report in reports)
+    lines.append(f"Merged away {merged} duplicate arrows in {len(reports)} file(s)")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge near-duplicate arrows in arrow JSON files")
+    parser.add_argument('paths', nargs='+', help="JSON files or folders of JSON files")
+    parser.add_argument('--radius', type=float, default=3.0, help="largest end distance (physical units)")
+    parser.add_argument('--angle', type=float, default=20.0, help="largest direction angle (degrees)")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be merged")
+    args = parser.parse_args()
+    reports = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            reports += merge_folder(path, args.radius, args.angle, args.dry_run)
+        else:
+            reports.append(merge_arrow_file(path, args.radius, args.angle, args.dry_run))
+    print(format_report(reports))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+arrow_store.py : Columnar (struct-of-arrays) storage for vector arrows
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module defines an ArrowStore class that keeps the arrows of a stack
+    in contiguous NumPy columns: an (N, 2, 3) array of [start, direction]
+    vectors in napari's layout, and compact colour index, width, opacity and
+    confidence columns. Appends grow the buffers geometrically, deletes swap the last
+    row into the hole, and every column can be read or written in bulk.
+"""
+
+import numpy as np
+
+
+class ArrowStore:
+    def __init__(self, capacity=64):
+        self._vectors = np.empty((capacity, 2, 3), dtype=np.float64)
+        self._color_ids = np.empty(capacity, dtype=np.uint16)
+        self._widths = np.empty(capacity, dtype=np.float64)
+        self._opacities = np.empty(capacity, dtype=np.float32)
+        # 自动生成（如时间点间传播）的箭头的置信度，手工标注的为 NaN
+        self._confidences = np.empty(capacity, dtype=np.float32)
+        # 颜色名调色板：每个箭头只存一个下标
+        self.palette = []
+        self._palette_ids = {}
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    # --- column views (valid until the next append/delete) ---
+    @property
+    def vectors(self):
+        return self._vectors[:self._n]
+
+    @property
+    def starts(self):
+        return self._vectors[:self._n, 0]
+
+    @property
+    def directions(self):
+        return self._vectors[:self._n, 1]
+
+    @property
+    def ends(self):
+        return self._vectors[:self._n, 0] + self._vectors[:self._n, 1]
+
+    @property
+    def lengths(self):
+        return np.linalg.norm(self._vectors[:self._n, 1], axis=1)
+
+    @property
+    def color_ids(self):
+        return self._color_ids[:self._n]
+
+    @property
+    def widths(self):
+        return self._widths[:self._n]
+
+    @property
+    def opacities(self):
+        return self._opacities[:self._n]
+
+    @property
+    def confidences(self):
+        return self._confidences[:self._n]
+
+    def colors(self, rows=slice(None)):
+        palette = np.array(self.palette, dtype=object)
+        return palette[self.color_ids[rows]].tolist() if len(palette) else []
+
+    def color_id(self, color):
+        if color not in self._palette_ids:
+            self._palette_ids[color] = len(self.palette)
+            self.palette.append(color)
+        return self._palette_ids[color]
+
+    def _reserve(self, n):
+        capacity = len(self._widths)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity)
+        for name in ('_vectors', '_color_ids', '_widths', '_opacities', '_confidences'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, name, new)
+
+    def append(self, start, direction, color, width, opacity, confidence=np.nan):
+        """:return: row of the new arrow"""
+        row = self._n
+        self._reserve(row + 1)
+        self._vectors[row, 0] = start
+        self._vectors[row, 1] = direction
+        self._color_ids[row] = self.color_id(color)
+        self._widths[row] = width
+        self._opacities[row] = opacity
+        self._confidences[row] = confidence
+        self._n += 1
+        return row
+
+    def extend(self, starts, directions, colors, widths, opacities, confidences=np.nan):
+        """
+        Append many arrows at once; colors is a sequence of names
+        :return: range of the new rows
+        """
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        first, count = self._n, len(starts)
+        self._reserve(first + count)
+        rows = slice(first, first + count)
+        self._vectors[rows, 0] = starts
+        self._vectors[rows, 1] = directions
+        self._color_ids[rows] = [self.color_id(c) for c in colors]
+        self._widths[rows] = widths
+        self._opacities[rows] = opacities
+        self._confidences[rows] = confidences
+        self._n += count
+        return range(first, first + count)
+
+    def swap_delete(self, row):
+        """
+        Remove a row in O(1) by moving the last row into it
+        :return: the old index of the row that moved into `row`, or None
+        """
+        last = self._n - 1
+        if not 0 <= row <= last:
+            raise IndexError(row)
+        moved = None
+        if row != last:
+            self._vectors[row] = self._vectors[last]
+            self._color_ids[row] = self._color_ids[last]
+            self._widths[row] = self._widths[last]
+            self._opacities[row] = self._opacities[last]
+            self._confidences[row] = self._confidences[last]
+            moved = last
+        self._n = last
+        return moved
+
+    def clear(self):
+        self._n = 0
+
+    def set(self, rows, start=None, direction=None, color=None, width=None, opacity=None):
+        """Vectorized write of any subset of columns for the given rows"""
+        if start is not None:
+            self._vectors[:self._n][rows, 0] = start
+        if direction is not None:
+            self._vectors[:self._n][rows, 1] = direction
+        if color is not None:
+            if isinstance(color, str):
+                self._color_ids[:self._n][rows] = self.color_id(color)
+            else:
+                self._color_ids[:self._n][rows] = [self.color_id(c) for c in color]
+        if width is not None:
+            self._widths[:self._n][rows] = width
+        if opacity is not None:
+            self._opacities[:self._n][rows] = opacity
+
+    def set_lengths(self, rows, lengths):
+        """Rescale directions to new lengths while keeping the arrow ends fixed"""
+        vectors = self._vectors[:self._n]
+        direction = vectors[rows, 1]
+        end = vectors[rows, 0] + direction
+        unit = direction / np.linalg.norm(direction, axis=-1, keepdims=True)
+        new_direction = unit * np.asarray(lengths, dtype=np.float64)[..., None]
+        vectors[rows, 1] = new_direction
+        vectors[rows, 0] = end - new_direction
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+arrow_table.py : Qt model/view table over the arrows of an ArrowManager
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module defines an ArrowTableModel exposing the ArrowStore of an
+    ArrowManager to a QTableView, and an ArrowItemDelegate that creates a
+    spin box or colour combo box only for the cell being edited and paints
+    the per-row Delete button, so the table costs nothing per hidden row.
+"""
+
+import numpy as np
+from qtpy.QtCore import Qt, QAbstractTableModel, QModelIndex, QPersistentModelIndex, QEvent, QTimer
+from qtpy.QtGui import QColor
+from qtpy.QtWidgets import (
+    QStyledItemDelegate, QDoubleSpinBox, QComboBox, QStyleOptionButton, QStyle, QApplication
+)
+
+COLUMNS = ['End Z', 'End Y', 'End X',
+           'Dir Z', 'Dir Y', 'Dir X',
+           'Color', 'Length', 'Width', 'Opacity', 'Conf', 'Delete']
+COLUMN_WIDTHS = [60, 60, 60, 60, 60, 60, 70, 50, 50, 55, 45, 65]
+COLOR_COLUMN, LENGTH_COLUMN, WIDTH_COLUMN, OPACITY_COLUMN = 6, 7, 8, 9
+CONFIDENCE_COLUMN, DELETE_COLUMN = 10, 11
+
+# (minimum, maximum, single step) of the spin box editing each numeric column
+SPIN_RANGES = {
+    **{j: (-9999, 9999, 1.0) for j in range(6)},
+    LENGTH_COLUMN: (0.1, 1000, 1.0),
+    WIDTH_COLUMN: (0.1, 50, 1.0),
+    OPACITY_COLUMN: (0.0, 1.0, 0.05),
+}
+
+# live edits are coalesced and applied at most once per frame
+EDIT_FLUSH_INTERVAL_MS = 16
+
+
+class ArrowTableModel(QAbstractTableModel):
+    """
+    Follows the change events of an ArrowManager. The store has already changed
+    when an event arrives, so the model reports its own row count until Qt has
+    been told about the insertion or removal
+    """
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+        self._rows = len(manager.store)
+        self._pending = {}
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(EDIT_FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self.flush_edits)
+        manager.events.inserted.connect(self._on_inserted)
+        manager.events.removed.connect(self._on_removed)
+        manager.events.changed.connect(self._on_changed)
+        manager.events.reset.connect(self._on_reset)
+
+    def _on_inserted(self, event):
+        self.beginInsertRows(QModelIndex(), event.first, event.last)
+        self._rows = len(self.manager.store)
+        self.endInsertRows()
+
+    def _on_removed(self, event):
+        self.beginRemoveRows(QModelIndex(), event.first, event.last)
+        self._rows = len(self.manager.store)
+        self.endRemoveRows()
+
+    def _on_changed(self, event):
+        if len(event.rows):
+            self.dataChanged.emit(self.index(int(event.rows.min()), 0),
+                                  self.index(int(event.rows.max()), len(COLUMNS) - 1))
+
+    def _on_reset(self, event):
+        self.beginResetModel()
+        self._rows = len(self.manager.store)
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._rows
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return COLUMNS[section]
+        return str(section + 1)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() not in (CONFIDENCE_COLUMN, DELETE_COLUMN):
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def value(self, row, column):
+        store = self.manager.store
+        start, direction = store.vectors[row]
+        if column < 3:
+            return float(start[column] + direction[column])
+        if column < 6:
+            return float(direction[column - 3])
+        if column == COLOR_COLUMN:
+            return store.palette[store.color_ids[row]]
+        if column == LENGTH_COLUMN:
+            return float(np.linalg.norm(direction))
+        if column == WIDTH_COLUMN:
+            return float(store.widths[row])
+        if column == OPACITY_COLUMN:
+            return float(store.opacities[row])
+        if column == CONFIDENCE_COLUMN:
+            return float(store.confidences[row])
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.column() == DELETE_COLUMN:
+            return None
+        row, column = index.row(), index.column()
+        if role == Qt.EditRole:
+            return self.value(row, column)
+        if role == Qt.DisplayRole:
+            value = self.value(row, column)
+            if column == CONFIDENCE_COLUMN and np.isnan(value):
+                return ''  # 手工标注的箭头没有置信度
+            return value if column == COLOR_COLUMN else f'{value:.2f}'
+        if role == Qt.DecorationRole and column == COLOR_COLUMN:
+            return QColor(self.value(row, column))
+        if role == Qt.TextAlignmentRole and column != COLOR_COLUMN:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        """Final commit of an edit: applies it together with any staged live edits"""
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        self.stage_edit(index, value)
+        self.flush_edits()
+        return True
+
+    def stage_edit(self, index, value):
+        """Record a live edit; all edits staged within one frame are applied together"""
+        if not index.isValid():
+            return
+        self._pending[(index.row(), index.column())] = value
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def flush_edits(self):
+        """Apply staged edits with one vectorized update per kind of column"""
+        self._flush_timer.stop()
+        pending, self._pending = self._pending, {}
+        pending = {(row, column): value for (row, column), value in pending.items()
+                   if row < len(self.manager.store) and value != self.value(row, column)}
+        if not pending:
+            return
+        store = self.manager.store
+        geometry = {}
+        for (row, column), value in pending.items():
+            if column < 6:
+                geometry.setdefault(row, []).append((column, value))
+        if geometry:
+            rows = np.fromiter(geometry, dtype=int)
+            ends, directions = store.ends[rows], store.directions[rows].copy()
+            for i, row in enumerate(rows):
+                for column, value in geometry[row]:
+                    if column < 3:
+                        ends[i, column] = value
+                    else:
+                        directions[i, column - 3] = value
+            self.manager.update_arrows(rows, start=ends - directions, direction=directions)
+
+        for column, key in ((COLOR_COLUMN, 'color'), (LENGTH_COLUMN, 'length'),
+                            (WIDTH_COLUMN, 'width'), (OPACITY_COLUMN, 'opacity')):
+            edits = {row: value for (row, c), value in pending.items() if c == column}
+            if not edits:
+                continue
+            rows = np.fromiter(edits, dtype=int)
+            values = list(edits.values())
+            self.manager.update_arrows(rows, **{key: values if column == COLOR_COLUMN
+                                                else np.array(values, dtype=np.float64)})
+
+
+class ArrowItemDelegate(QStyledItemDelegate):
+    """
+    Editors are created on demand for one cell at a time. Every change is staged
+    on the model, which applies the staged edits once per frame, so holding a
+    spin box arrow or scrolling the wheel does not flood the renderer; closing
+    the editor commits the final value immediately
+    """
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+
+    def createEditor(self, parent, option, index):
+        column = index.column()
+        if column in (CONFIDENCE_COLUMN, DELETE_COLUMN):
+            return None
+        model, persistent = index.model(), QPersistentModelIndex(index)
+        if column == COLOR_COLUMN:
+            from main_app import available_colors
+            editor = QComboBox(parent)
+            editor.addItems(available_colors)
+            editor.currentTextChanged.connect(lambda text: model.stage_edit(persistent, text))
+            return editor
+        editor = QDoubleSpinBox(parent)
+        minimum, maximum, step = SPIN_RANGES[column]
+        editor.setDecimals(2)
+        editor.setRange(minimum, maximum)
+        editor.setSingleStep(step)
+        editor.valueChanged.connect(lambda value: model.stage_edit(persistent, value))
+        return editor
+
+    def setEditorData(self, editor, index):
+        value = index.model().value(index.row(), index.column())
+        editor.blockSignals(True)
+        if isinstance(editor, QComboBox):
+            # 不在可选列表中的颜色也要能显示，否则编辑器会落到第一项上
+            if editor.findText(value) < 0:
+                editor.addItem(value)
+            editor.setCurrentText(value)
+        else:
+            editor.setValue(value)
+        editor.blockSignals(False)
+
+    def setModelData(self, editor, model, index):
+        # 只是经过单元格、没有修改时不提交：编辑器显示的是四舍五入后的值
+        stored = model.value(index.row(), index.column())
+        if isinstance(editor, QComboBox):
+            if editor.currentText() != stored:
+                model.setData(index, editor.currentText())
+        elif abs(editor.value() - stored) > 0.5 * 10 ** -editor.decimals() + 1e-9:
+            model.setData(index, editor.value())
+
+    def paint(self, painter, option, index):
+        if index.column() != DELETE_COLUMN:
+            super().paint(painter, option, index)
+            return
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(2, 2, -2, -2)
+        button.text = 'Delete'
+        button.state = QStyle.State_Enabled
+        QApplication.style().drawControl(QStyle.CE_PushButton, button, painter)
+
+    def editorEvent(self, event, model, option, index):
+        if (index.column() == DELETE_COLUMN
+                and event.type() == QEvent.MouseButtonRelease
+                and option.rect.contains(event.pos())):
+            self.manager.delete_arrow(index.row())
+            return True
+        return super().editorEvent(event, model, option, index)
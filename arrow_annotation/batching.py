@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+batching.py : Grouping of many layer/table mutations into one update, with timing
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module defines a Batcher used by ArrowManager and TIFFManager to
+    open nested batches whose changes are flushed once when the outermost
+    batch closes, a context manager that holds back repaints of the napari
+    window for the duration of a batch, and a small timing helper.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class Batcher:
+    """
+    Nestable batch context. Inside a batch, owners mark themselves dirty instead
+    of emitting their change notifications; on_flush runs once, when the
+    outermost batch closes and something changed
+    """
+    def __init__(self, on_flush=None, on_enter=None, on_exit=None):
+        self.depth = 0
+        self.dirty = False
+        self._on_flush = on_flush
+        self._on_enter = on_enter
+        self._on_exit = on_exit
+
+    @property
+    def active(self):
+        return self.depth > 0
+
+    @contextmanager
+    def __call__(self):
+        if self.depth == 0 and self._on_enter:
+            self._on_enter()
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                try:
+                    if self.dirty and self._on_flush:
+                        self.dirty = False
+                        self._on_flush()
+                finally:
+                    if self._on_exit:
+                        self._on_exit()
+
+
+def qt_window(viewer):
+    window = getattr(viewer, 'window', None)
+    return getattr(window, '_qt_window', None)
+
+
+@contextmanager
+def suspended_repaints(viewer):
+    """
+    Hold back Qt repaints of the whole napari window (canvas, layer list, dock
+    widgets) so a series of layer mutations is drawn once when the block exits
+    """
+    widget = qt_window(viewer)
+    if widget is None or not widget.updatesEnabled():
+        yield
+        return
+    widget.setUpdatesEnabled(False)
+    try:
+        yield
+    finally:
+        widget.setUpdatesEnabled(True)
+        widget.update()
+
+
+@contextmanager
+def timed(label, enabled=True, sink=None):
+    """
+    Measure the wall time of a block
+    :param sink: optional dict that receives {label: milliseconds}
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        if sink is not None:
+            sink[label] = ms
+        if enabled:
+            print(f"[timing] {label}: {ms:.1f} ms")
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+folder_index.py : Persistent per-folder index of TIFF stacks and their metadata
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module defines a FolderIndex class that keeps a small SQLite database
+    next to the TIFF stacks of a folder. It records size, mtime, shape, dtype,
+    page count, compression and pixel size of every stack, read from the TIFF
+    headers only, and is brought up to date incrementally from a scandir diff.
+    It also serves as the sidecar cache for per-stack contrast statistics and
+    for the drift transforms registered between pairs of stacks.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tifffile
+
+INDEX_NAME = '.tiff_index.sqlite'
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    shape       TEXT,
+    dtype       TEXT,
+    pages       INTEGER,
+    compression TEXT,
+    pixel_size  TEXT
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    stats       TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS registration (
+    name_a      TEXT NOT NULL,
+    name_b      TEXT NOT NULL,
+    options     TEXT NOT NULL,
+    signature   TEXT NOT NULL,
+    transform   TEXT NOT NULL,
+    PRIMARY KEY (name_a, name_b, options)
+)
+"""
+
+
+def _resolution(tags, name):
+    tag = tags.get(name)
+    if tag is None:
+        return None
+    num, den = tag.value
+    return den / num if num else None
+
+
+def read_tiff_metadata(path):
+    """
+    Read shape, dtype, page count, compression and (z, y, x) pixel size of a
+    stack from its header, without decoding any pixel data
+    """
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        page = tif.pages[0]
+        pixel_size = None
+        ij = tif.imagej_metadata
+        unit = page.tags.get('ResolutionUnit')
+        if ij is not None:
+            pixel_size = [ij.get('spacing'),
+                          _resolution(page.tags, 'YResolution'),
+                          _resolution(page.tags, 'XResolution')]
+        elif unit is not None and unit.value == 3:
+            # RESUNIT_CENTIMETER -> µm
+            pixel_size = [None] + [None if r is None else r * 1e4 for r in
+                                   (_resolution(page.tags, 'YResolution'),
+                                    _resolution(page.tags, 'XResolution'))]
+        return {
+            'shape': list(series.shape),
+            'dtype': str(series.dtype),
+            'pages': len(tif.pages),
+            'compression': page.compression.name,
+            'pixel_size': pixel_size,
+        }
+
+
+class FolderIndex:
+    def __init__(self, folder_path, workers=4):
+        self.folder_path = folder_path
+        self.workers = workers
+        self._lock = threading.Lock()
+        db_path = os.path.join(folder_path, INDEX_NAME)
+        try:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        except sqlite3.Error:
+            # 只读目录：退回内存索引
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def update(self):
+        """
+        Diff the folder against the index and re-read headers only for stacks
+        that are new or whose size/mtime changed
+        :return: (number of added or changed entries, number of removed entries)
+        """
+        on_disk = {}
+        with os.scandir(self.folder_path) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(TIFF_EXTENSIONS):
+                    stat = entry.stat()
+                    on_disk[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            known = {name: (size, mtime) for name, size, mtime in
+                     self._conn.execute('SELECT name, size, mtime_ns FROM files')}
+        removed = [name for name in known if name not in on_disk]
+        changed = [name for name, sig in on_disk.items() if known.get(name) != sig]
+
+        def read(name):
+            try:
+                return read_tiff_metadata(os.path.join(self.folder_path, name))
+            except Exception as e:
+                print(f"Could not read TIFF header of {name}: {e}")
+                return {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            metadata = list(pool.map(read, changed))
+
+        rows = []
+        for name, meta in zip(changed, metadata):
+            size, mtime = on_disk[name]
+            rows.append((name, size, mtime,
+                         json.dumps(meta.get('shape')), meta.get('dtype'),
+                         meta.get('pages'), meta.get('compression'),
+                         json.dumps(meta.get('pixel_size'))))
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM files WHERE name = ?',
+                                   [(name,) for name in removed])
+            self._conn.executemany('DELETE FROM stats WHERE name = ?',
+                                   [(name,) for name in removed])
+            self._conn.executemany('DELETE FROM registration WHERE name_a = ? OR name_b = ?',
+                                   [(name, name) for name in removed])
+            self._conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   rows)
+        return len(changed), len(removed)
+
+    def names(self):
+        with self._lock:
+            return [name for name, in
+                    self._conn.execute('SELECT name FROM files ORDER BY name')]
+
+    def files(self):
+        return [os.path.join(self.folder_path, name) for name in self.names()]
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM files WHERE name = ?',
+                                     (os.path.basename(path),)).fetchone()
+        if row is None:
+            return None
+        name, size, mtime, shape, dtype, pages, compression, pixel_size = row
+        return {
+            'name': name, 'size': size, 'mtime_ns': mtime,
+            'shape': None if shape is None else json.loads(shape),
+            'dtype': dtype, 'pages': pages, 'compression': compression,
+            'pixel_size': None if pixel_size is None else json.loads(pixel_size),
+        }
+
+    def get_stats(self, path):
+        """Cached stack statistics (see stack_stats), None if missing or out of date"""
+        stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute('SELECT stats FROM stats WHERE name = ? AND size = ? AND mtime_ns = ?',
+                                     (os.path.basename(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_stats(self, path, stats):
+        stat = os.stat(path)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?)',
+                               (os.path.basename(path), stat.st_size, stat.st_mtime_ns,
+                                json.dumps(stats)))
+
+    @staticmethod
+    def _pair_signature(path_a, path_b):
+        a, b = os.stat(path_a), os.stat(path_b)
+        return json.dumps([a.st_size, a.st_mtime_ns, b.st_size, b.st_mtime_ns])
+
+    def get_registration(self, path_a, path_b, options):
+        """
+        Cached transform from stack path_a to path_b (see registration.register)
+        computed with the given options, None if missing or either stack changed
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT signature, transform FROM registration '
+                                     'WHERE name_a = ? AND name_b = ? AND options = ?',
+                                     (os.path.basename(path_a), os.path.basename(path_b),
+                                      json.dumps(options, sort_keys=True))).fetchone()
+        if row is None or row[0] != self._pair_signature(path_a, path_b):
+            return None
+        return json.loads(row[1])
+
+    def put_registration(self, path_a, path_b, options, transform):
+        signature = self._pair_signature(path_a, path_b)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO registration VALUES (?, ?, ?, ?, ?)',
+                               (os.path.basename(path_a), os.path.basename(path_b),
+                                json.dumps(options, sort_keys=True), signature,
+                                json.dumps(transform)))
+
+    def find(self, text):
+        """Position of the first stack whose file name contains text, or None"""
+        for i, name in enumerate(self.names()):
+            if text in name:
+                return i
+        return None
@@ -20,12 +20,26 @@ Description:
 import os
 import numpy as np
 import napari
+from napari.qt.threading import create_worker
+from napari.utils.notifications import show_error, show_warning
 from qtpy.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTableWidget, QLineEdit, QFileDialog, QMenu
+    QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTableView, QLineEdit, QFileDialog, QMenu,
+    QProgressBar, QAbstractItemView, QShortcut, QApplication
 )
-from vector_arrow import ArrowManager
+from qtpy.QtGui import QKeySequence
+from vector_arrow import ArrowManager, read_arrow_file
+from arrow_table import COLUMN_WIDTHS
+from batching import timed
 from tiff_manager import TIFFManager
-import glob
+from arrow_merge import merge_folder, format_report
+from picking import pick_max_along_ray
+from triangulation import triangulate
+from refinement import refine_point
+from detection import detect_blobs
+from orientation import orient
+from propagation import track_targets
+from registration import apply_transform
+from overlay import frame_and_grid
 import json
 
 with open('config.json', 'r') as f:
@@ -39,70 +53,127 @@ default_arrow_length = config['default_arrow_length']
 default_arrow_color = config['default_arrow_color']
 default_arrow_width = config['default_arrow_width']
 default_arrow_opacity = config['default_arrow_opacity']
-
-tif_files = sorted(glob.glob(os.path.join(default_path, '*.tif'))
-                   + glob.glob(os.path.join(default_path, '*.tiff')))
-default_json_path = os.path.splitext(tif_files[0])[0] + '.json'
+prefetch_depth = config.get('prefetch_depth', 2)
+volume_cache_bytes = int(config.get('volume_cache_gb', 4) * 1024 ** 3)
+lazy_loading = config.get('lazy_loading', False)
+contrast_percentiles = tuple(config.get('contrast_percentiles', (0.5, 99.9)))
+multiscale_bytes = int(config.get('multiscale_threshold_mb', 512) * 1024 ** 2)
+log_timings = config.get('log_timings', False)
+spatial_cell_size = config.get('spatial_cell_size', 20)
+pick_radius = config.get('pick_radius', 10)
+duplicate_radius = config.get('duplicate_radius', 3)
+merge_radius = config.get('merge_radius', 3)
+merge_max_angle = config.get('merge_max_angle', 20)
+max_triangulation_residual = config.get('max_triangulation_residual', 5)
+max_triangulation_condition = config.get('max_triangulation_condition', 5000)
+refine_picks = config.get('refine_picks', False)
+refine_radius = config.get('refine_radius', 4)
+detection_min_sigma = config.get('detection_min_sigma', 3)
+detection_max_sigma = config.get('detection_max_sigma', 8)
+detection_scales = config.get('detection_scales', 3)
+detection_threshold = config.get('detection_threshold', 0.1)
+auto_orient = config.get('auto_orient', False)
+orient_radius = config.get('orient_radius', 6)
+orient_min_coherence = config.get('orient_min_coherence', 0.2)
+propagate_annotations = config.get('propagate_annotations', False)
+propagation_patch_radius = config.get('propagation_patch_radius', 6)
+propagation_search_radius = config.get('propagation_search_radius', 10)
+propagation_min_confidence = config.get('propagation_min_confidence', 0.3)
+register_stacks = config.get('register_stacks', False)
+registration_rotation = config.get('registration_rotation', False)
+drift_correction = config.get('drift_correction', False)
+grid_interval = config.get('grid_interval', 60)
+max_grid_lines = config.get('max_grid_lines', 1000)
 
 
 class MainApp:
     def __init__(self):
         self.viewer = napari.Viewer(ndisplay=3)
-        self.ray_info = {'first': None, 'second': None}
-
-        self.table = self._init_table()
+        # 已记录的视线 (pos, direction)，x, y, z 顺序
+        self.ray_info = []
+        self._detect_worker = None
+        # 前进到下一个栈时记下当前的体数据和箭头，供传播使用
+        self._propagation_source = None
+        # 边框网格图层及其几何 (shape, scale, grid_interval)
+        self._grid_layer = None
+        self._grid_signature = None
+
+        self.table = QTableView()
         self.save_path_input = QLineEdit()
         self.load_path_input = QLineEdit()
         self.view_path_input = QLineEdit()
+        self.jump_input = QLineEdit()
+        self.load_progress = QProgressBar()
         self.snapshot_dir = os.path.join(default_path, 'snapshots')
         os.makedirs(self.snapshot_dir, exist_ok=True)
 
-        self.arrow_manager = ArrowManager(self.viewer, self.table)
+        self.arrow_manager = ArrowManager(self.viewer, self.table, cell_size=spatial_cell_size)
+        self._init_table()
         self.tiff_manager = TIFFManager(self.viewer,
                                         default_path,
-                                        default_json_path,
-                                        self.load_vectors)
+                                        None,
+                                        self._on_stack_loaded,
+                                        prefetch_depth=prefetch_depth,
+                                        cache_bytes=volume_cache_bytes,
+                                        lazy=lazy_loading,
+                                        busy_callback=self._set_loading,
+                                        failed_callback=self._on_stack_failed,
+                                        contrast_percentiles=contrast_percentiles,
+                                        scale=image_pixel_size,
+                                        multiscale_bytes=multiscale_bytes,
+                                        log_timings=log_timings,
+                                        registration={'rotation': registration_rotation}
+                                        if register_stacks or drift_correction else None)
 
         self._init_ui()
         self.tiff_manager.load_current()
         # self._add_volume_bounding_box()
-        self._add_enhanced_frame_and_grid(grid_interval=60)
 
+    def _bind_image_layer(self):
+        """
+        Hook the picking callback onto the image layer and select it; a no-op
+        for the callback when the layer was reused across a stack switch
+        """
+        layer = self.tiff_manager.image_layer
+        if self.handle_right_click not in layer.mouse_double_click_callbacks:
+            layer.mouse_double_click_callbacks.clear()
+            layer.mouse_double_click_callbacks.append(self.handle_right_click)
         self.viewer.layers.selection.clear()
-        self.viewer.layers.selection.add(self.tiff_manager.image_layer)
-
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.clear()
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.append(self.handle_right_click)
+        self.viewer.layers.selection.add(layer)
 
     def _init_table(self):
-        table = QTableWidget()
-        table.setColumnCount(11)
-        table.setHorizontalHeaderLabels([
-            'End Z', 'End Y', 'End X',
-            'Dir Z', 'Dir Y', 'Dir X',
-            'Color', 'Length', 'Width', 'Opacity', 'Delete'
-        ])
-        for i in range(6):
-            table.setColumnWidth(i, 60)
-        table.setColumnWidth(6, 70)
-        table.setColumnWidth(7, 50)
-        table.setColumnWidth(8, 50)
-        table.setColumnWidth(9, 55)
-        table.setColumnWidth(10, 65)
-        return table
+        # 列由 ArrowTableModel 提供，这里只设置外观和编辑方式
+        table = self.table
+        for i, width in enumerate(COLUMN_WIDTHS):
+            table.setColumnWidth(i, width)
+        table.setEditTriggers(QAbstractItemView.AllEditTriggers)
+        table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        table.verticalHeader().setDefaultSectionSize(24)
+        # 复制/粘贴箭头（制表符分隔，列顺序同表格）
+        QShortcut(QKeySequence.Copy, table, activated=self.copy_arrows)
+        QShortcut(QKeySequence.Paste, table, activated=self.paste_arrows)
 
     def _init_ui(self):
-        save_btn = QPushButton("Save Vectors")
-        load_btn = QPushButton("Load Vectors")
+        save_btn = self.save_btn = QPushButton("Save Vectors")
+        load_btn = self.load_btn = QPushButton("Load Vectors")
         clear_btn = QPushButton("Clear Vectors")
         prev_btn = QPushButton("Prev TIFF")
         next_btn = QPushButton("Next TIFF")
         sync_view_btn = QPushButton("Synchronous view")
         change_path_btn = QPushButton("Select Folder")
         snap_btn = QPushButton("Snapshot")
-
+        jump_btn = QPushButton("Jump to TIFF")
+        merge_btn = QPushButton("Merge Duplicates")
+        merge_folder_btn = QPushButton("Merge Duplicates in Folder")
+        detect_btn = QPushButton("Detect Candidates")
+        accept_btn = self.accept_btn = QPushButton("Accept Candidates")
+        orient_btn = QPushButton("Auto-Orient Arrows")
+        register_btn = QPushButton("Register Folder")
+
+        default_json_path = self.tiff_manager.json_path
         self.save_path_input.setText(default_json_path)
         self.load_path_input.setText(default_json_path)
+        self.jump_input.setPlaceholderText("File name or part of it")
         self.view_path_input.setText(os.path.join(self.snapshot_dir, 'example_view.npz'))
 
         controls = QWidget()
@@ -127,12 +198,35 @@ class MainApp:
 
         layout.addWidget(clear_btn)
 
+        hlayout_merge = QHBoxLayout()
+        hlayout_merge.addWidget(merge_btn)
+        hlayout_merge.addWidget(merge_folder_btn)
+        layout.addLayout(hlayout_merge)
+
+        hlayout_detect = QHBoxLayout()
+        hlayout_detect.addWidget(detect_btn)
+        hlayout_detect.addWidget(accept_btn)
+        hlayout_detect.addWidget(orient_btn)
+        layout.addLayout(hlayout_detect)
+
         hlayout4 = QHBoxLayout()
         hlayout4.addWidget(prev_btn)
         hlayout4.addWidget(next_btn)
+        hlayout4.addWidget(register_btn)
         layout.addLayout(hlayout4)
 
+        hlayout5 = QHBoxLayout()
+        hlayout5.addWidget(self.jump_input)
+        hlayout5.addWidget(jump_btn)
+        layout.addLayout(hlayout5)
+
         layout.addWidget(snap_btn)
+        # 加载中显示忙碌进度条
+        self.load_progress.setRange(0, 0)
+        self.load_progress.setTextVisible(False)
+        self.load_progress.setFixedHeight(6)
+        self.load_progress.hide()
+        layout.addWidget(self.load_progress)
         layout.addWidget(self.table)
 
         controls.setLayout(layout)
@@ -142,79 +236,321 @@ class MainApp:
         save_btn.clicked.connect(self.save_vectors)
         load_btn.clicked.connect(self.load_vectors_from_input)
         clear_btn.clicked.connect(self.arrow_manager.clear_arrows)
+        merge_btn.clicked.connect(self.merge_duplicate_arrows)
+        merge_folder_btn.clicked.connect(self.merge_duplicate_arrows_in_folder)
+        detect_btn.clicked.connect(self.detect_candidates)
+        accept_btn.clicked.connect(self.accept_candidates)
+        orient_btn.clicked.connect(self.auto_orient_arrows)
+        register_btn.clicked.connect(self.register_folder)
         # prev_btn.clicked.connect(self.tiff_manager.prev)
         prev_btn.clicked.connect(self.prev_tif)
         # next_btn.clicked.connect(self.tiff_manager.next)
         next_btn.clicked.connect(self.next_tif)
+        jump_btn.clicked.connect(self.jump_to_tif)
+        self.jump_input.returnPressed.connect(self.jump_to_tif)
         change_path_btn.clicked.connect(self.change_default_path)
         snap_btn.clicked.connect(self.save_snapshot_and_view)
         sync_view_btn.clicked.connect(self.restore_view_from_textbox)
 
     def prev_tif(self):
-        self.save_vectors()
-        self.arrow_manager.clear_arrows()
+        self._propagation_source = None
+        self._leave_current_stack()
         self.tiff_manager.prev()
-        current_json = self.tiff_manager.json_path
-        self.save_path_input.setText(current_json)
-
-        self._clear_enhanced_grid()
-        self._add_enhanced_frame_and_grid(grid_interval=60)
-
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.clear()
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.append(self.handle_right_click)
-        self.viewer.layers.selection.clear()
-        self.viewer.layers.selection.add(self.tiff_manager.image_layer)
 
     def next_tif(self):
-        self.save_vectors()
-        self.arrow_manager.clear_arrows()
+        # 连续快速翻页时（上一个栈还在加载）或从最后一个栈绕回第一个时不传播，避免错配
+        self._propagation_source = None
+        tiff_manager = self.tiff_manager
+        if (propagate_annotations and not tiff_manager.is_loading
+                and tiff_manager.index < len(tiff_manager.files) - 1):
+            self._propagation_source = self._snapshot_arrows()
+        self._leave_current_stack()
         self.tiff_manager.next()
-        current_json = self.tiff_manager.json_path
-        self.save_path_input.setText(current_json)
 
-        self._clear_enhanced_grid()
-        self._add_enhanced_frame_and_grid(grid_interval=60)
+    def jump_to_tif(self):
+        text = self.jump_input.text().strip()
+        if not text or self.tiff_manager.folder_index.find(text) is None:
+            print(f"No TIFF matching '{text}'")
+            return
+        self._propagation_source = None
+        self._leave_current_stack()
+        self.tiff_manager.jump_to_file(text)
 
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.clear()
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.append(self.handle_right_click)
-        self.viewer.layers.selection.clear()
-        self.viewer.layers.selection.add(self.tiff_manager.image_layer)
+    def _leave_current_stack(self):
+        # 加载进行中时箭头已保存并清空，不能再用空列表覆盖上一个 json
+        if self.tiff_manager.is_loading:
+            return
+        with timed('save vectors', log_timings, self.tiff_manager.timings):
+            self.save_vectors()
+        self.arrow_manager.clear_arrows()
+        # 新栈载入前不再指向上一个栈的 json，免得把空列表写进去
+        self.save_path_input.setText('')
+        self._remove_candidates()
+
+    def _on_stack_loaded(self, json_path, records):
+        """Called by TIFFManager once a stack is displayed, sync or async"""
+        self.save_path_input.setText(json_path)
+        with self.arrow_manager.transaction():
+            self.load_vectors(json_path, records)
+
+            self._add_enhanced_frame_and_grid(grid_interval=grid_interval)
+            self._bind_image_layer()
+        source, self._propagation_source = self._propagation_source, None
+        # 只在下一个栈还没有标注时传播
+        if source is not None and not records:
+            self._propagate(source)
+
+    def _snapshot_arrows(self):
+        """Volume and arrow columns of the current stack, or None if there is nothing to propagate"""
+        store = self.arrow_manager.store
+        if self.tiff_manager.volume is None or not len(store):
+            return None
+        return (self.tiff_manager.get_current_file_name(), self.tiff_manager.volume,
+                store.ends.copy(), store.directions.copy(),
+                store.colors(), store.widths.copy(), store.opacities.copy())
+
+    def _propagate(self, source):
+        """Track the previous stack's arrow ends into the current stack in the background"""
+        previous, volume, ends, directions, colors, widths, opacities = source
+        next_volume = self.tiff_manager.volume
+        if next_volume is None or next_volume.shape != volume.shape:
+            return
+        file = self.tiff_manager.get_current_file_name()
+
+        def track():
+            guesses = None
+            if drift_correction:
+                # 先按整体漂移移动箭头，局部跟踪只需搜索剩余的位移
+                transform = self.tiff_manager.get_transform(previous, file, compute=True)
+                guesses, directions_moved = apply_transform(transform, ends, directions)
+            else:
+                directions_moved = directions
+            moved, confidences = track_targets(volume, next_volume, image_pixel_size, ends,
+                                               propagation_patch_radius, propagation_search_radius,
+                                               guesses=guesses)
+            return moved, directions_moved, confidences
+
+        worker = create_worker(track, _start_thread=False,
+                               _connect={'returned': lambda result: self._add_propagated(
+                                             file, result, colors, widths, opacities),
+                                         'errored': lambda e: show_error(f"Propagation failed: {e}")})
+        worker.start()
+
+    def _add_propagated(self, file, result, colors, widths, opacities):
+        if file != self.tiff_manager.get_current_file_name():
+            return
+        ends, directions, confidences = result
+        keep = confidences >= propagation_min_confidence
+        self.arrow_manager.add_arrows(ends[keep], directions[keep],
+                                      [c for c, ok in zip(colors, keep) if ok],
+                                      widths[keep], opacities[keep], confidences[keep])
+        print(f"Propagated {keep.sum()} of {len(keep)} arrows from the previous stack "
+              f"(confidence >= {propagation_min_confidence})")
+
+    def _set_loading(self, busy):
+        self.load_progress.setVisible(busy)
+        # 加载中箭头已清空、路径已指向别处，不能存取，新加的箭头也会随新栈载入丢失
+        loading = self.tiff_manager.is_loading
+        self.save_btn.setEnabled(not loading)
+        self.load_btn.setEnabled(not loading)
+        self.accept_btn.setEnabled(not loading)
+
+    def _refuse_while_loading(self):
+        if self.tiff_manager.is_loading:
+            print("Not adding arrows: the next stack is still loading")
+            return True
+        return False
+
+    def _on_stack_failed(self, json_path):
+        """The next stack could not be loaded: bring back the arrows of the one still shown"""
+        self.save_path_input.setText(json_path)
+        self.load_vectors(json_path)
 
     def save_vectors(self):
         path = self.save_path_input.text()
+        if self.tiff_manager.is_loading or not path:
+            print("Not saving: no stack is loaded")
+            return
         self.arrow_manager.save_to_file(path)
 
-    def load_vectors(self, path):
-        self.arrow_manager.load_from_file(path)
+    def load_vectors(self, path, records=None, transform=None):
+        self.arrow_manager.load_from_file(path, records, transform)
+
+    def _stack_of(self, json_path):
+        """The stack of the folder a JSON file belongs to, if it is not the current one"""
+        stem = os.path.splitext(os.path.abspath(json_path))[0]
+        current = self.tiff_manager.get_current_file_name()
+        for file in self.tiff_manager.files:
+            if os.path.splitext(os.path.abspath(file))[0] == stem and file != current:
+                return file
+        return None
+
+    def register_folder(self):
+        """Register all consecutive stacks of the folder in the background, cached for reuse"""
+        files = list(self.tiff_manager.files)
+        worker = create_worker(self.tiff_manager.register_all, _start_thread=False,
+                               _connect={'returned': lambda transforms: print('\n'.join(
+                                   f"{os.path.basename(a)} -> {os.path.basename(b)}: translation "
+                                   f"{np.round(t['translation'], 2).tolist()}, angle {t['angle']:.2f}, "
+                                   f"score {t['score']:.3f}"
+                                   for a, b, t in zip(files, files[1:], transforms))),
+                                         'errored': lambda e: show_error(f"Registration failed: {e}")})
+        worker.start()
+
+    def merge_duplicate_arrows(self):
+        groups = self.arrow_manager.merge_duplicates(merge_radius, merge_max_angle)
+        print(format_report([{'file': self.save_path_input.text(),
+                              'before': len(self.arrow_manager.store) + sum(len(g) - 1 for g in groups),
+                              'after': len(self.arrow_manager.store),
+                              'groups': groups}]))
+
+    def merge_duplicate_arrows_in_folder(self):
+        # 当前栈先存盘，合并所有 json 后再重新载入当前栈
+        if self.tiff_manager.is_loading:
+            return
+        self.save_vectors()
+        reports = merge_folder(self.tiff_manager.folder_path, merge_radius, merge_max_angle)
+        print(format_report(reports))
+        path = self.save_path_input.text()
+        with self.arrow_manager.transaction():
+            self.load_vectors(path)
+
+    def detect_candidates(self):
+        """Find cell candidates in the current stack in the background (see detection)"""
+        volume = self.tiff_manager.volume
+        if volume is None or self._detect_worker is not None:
+            return
+        file = self.tiff_manager.get_current_file_name()
+        worker = create_worker(detect_blobs, volume, image_pixel_size,
+                               detection_min_sigma, detection_max_sigma,
+                               detection_scales, detection_threshold,
+                               _start_thread=False,
+                               _connect={'returned': lambda result: self._show_candidates(file, result),
+                                         'errored': lambda e: show_error(f"Candidate detection failed: {e}"),
+                                         'finished': self._on_detection_finished})
+        self._detect_worker = worker
+        self._set_loading(True)
+        worker.start()
+
+    def _on_detection_finished(self):
+        self._detect_worker = None
+        self._set_loading(self.tiff_manager.is_loading)
+
+    def _show_candidates(self, file, result):
+        # 检测期间切换了栈：结果作废
+        if file != self.tiff_manager.get_current_file_name():
+            return
+        points, responses, sigmas = result
+        # 已有箭头的位置不再作为候选
+        new = np.array([self.arrow_manager.find_duplicate(p, duplicate_radius) is None
+                        for p in points], dtype=bool)
+        points, sigmas = points[new], sigmas[new]
+        self._remove_candidates()
+        self.viewer.add_points(points, name='Candidates', size=2 * np.sqrt(3) * sigmas,
+                               face_color='yellow', opacity=0.5)
+        self._bind_image_layer()
+        print(f"{len(points)} candidates; delete unwanted points, then Accept Candidates")
+
+    def accept_candidates(self):
+        """Turn the remaining candidate points into default arrows"""
+        if 'Candidates' not in self.viewer.layers or self._refuse_while_loading():
+            return
+        ends = np.asarray(self.viewer.layers['Candidates'].data, dtype=float).reshape(-1, 3)
+        directions = self._arrow_directions(ends, auto_orient) * default_arrow_length
+        self.arrow_manager.add_arrows(ends, directions, default_arrow_color,
+                                      default_arrow_width, default_arrow_opacity)
+        self._remove_candidates()
+        self._bind_image_layer()
+
+    def _arrow_directions(self, ends, oriented):
+        """
+        Unit directions (N, 3) for new arrows ending at ends: default_arrow_direction,
+        or the local structure axis when oriented (see orientation)
+        """
+        ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+        unit_direction = default_arrow_direction / np.linalg.norm(default_arrow_direction)
+        volume = self.tiff_manager.volume
+        if not oriented or volume is None:
+            return np.tile(unit_direction, (len(ends), 1))
+        return orient(volume, image_pixel_size, ends, orient_radius,
+                      unit_direction, orient_min_coherence)[0]
+
+    def auto_orient_arrows(self):
+        """Re-orient the selected arrows (all if none is selected), keeping their ends and lengths"""
+        store = self.arrow_manager.store
+        rows = sorted({index.row() for index in self.table.selectionModel().selectedRows()})
+        rows = np.array(rows, dtype=int) if rows else np.arange(len(store))
+        if not len(rows) or self.tiff_manager.volume is None:
+            return
+        ends, lengths = store.ends[rows], store.lengths[rows]
+        directions = self._arrow_directions(ends, True) * lengths[:, None]
+        self.arrow_manager.update_arrows(rows, start=ends - directions, direction=directions)
+
+    def _remove_candidates(self):
+        if 'Candidates' in self.viewer.layers:
+            self.viewer.layers.remove('Candidates')
+
+    def copy_arrows(self):
+        rows = sorted({index.row() for index in self.table.selectionModel().selectedRows()})
+        if rows:
+            QApplication.clipboard().setText(self.arrow_manager.copy_text(rows))
+
+    def select_arrow(self, row):
+        self.table.selectRow(row)
+        self.table.scrollTo(self.arrow_manager.model.index(row, 0))
+
+    def paste_arrows(self):
+        if self._refuse_while_loading():
+            return
+        try:
+            self.arrow_manager.paste_text(QApplication.clipboard().text())
+        except ValueError as e:
+            print(f"Could not paste arrows: {e}")
 
     def load_vectors_from_input(self):
-        self.load_vectors(self.load_path_input.text())
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.clear()
-        self.tiff_manager.image_layer.mouse_double_click_callbacks.append(self.handle_right_click)
-        self.viewer.layers.selection.clear()
-        self.viewer.layers.selection.add(self.tiff_manager.image_layer)
+        path = self.load_path_input.text()
+        source = self._stack_of(path) if drift_correction else None
+        if source is None:
+            self.load_vectors(path)
+            self._bind_image_layer()
+            return
+        # 载入其他栈的标注时按两栈之间的漂移移动箭头；配准可能要解码两个栈，放到后台
+        file = self.tiff_manager.get_current_file_name()
+
+        def drift_and_read():
+            records = read_arrow_file(path)
+            try:
+                return self.tiff_manager.drift_between(source, file), records, None
+            except Exception as e:
+                # 中间某对栈配准失败时不校正，箭头照常载入
+                return None, records, e
+
+        worker = create_worker(drift_and_read, _start_thread=False,
+                               _connect={'returned': lambda result: self._load_drift_corrected(
+                                             file, path, *result),
+                                         'errored': lambda e: show_error(f"Could not load {path}: {e}")})
+        worker.start()
+
+    def _load_drift_corrected(self, file, path, transform, records, error):
+        if file != self.tiff_manager.get_current_file_name():
+            return
+        if transform is None:
+            show_warning(f"Drift correction of {path} failed, loaded uncorrected: {error}")
+        else:
+            print(f"Drift-corrected by {np.round(transform['translation'], 2).tolist()}, "
+                  f"angle {transform['angle']:.2f}")
+        self.load_vectors(path, records, transform)
+        self._bind_image_layer()
 
     def change_default_path(self):
         new_path = QFileDialog.getExistingDirectory(None, "Select Folder", default_path)
         if new_path:
-            tif_files = sorted(glob.glob(os.path.join(new_path, '*.tif'))
-                               + glob.glob(os.path.join(new_path, '*.tiff')))
-            first_tif = os.path.splitext(tif_files[0])[0]
-
             self.tiff_manager.folder_path = new_path
             self.tiff_manager.reload_file_list()
-            self.save_path_input.setText(os.path.join(new_path, f'{first_tif}.json'))
-            self.load_path_input.setText(os.path.join(new_path, f'{first_tif}.json'))
+            first_json = self.tiff_manager.get_current_json_path()
+            self.save_path_input.setText(first_json)
+            self.load_path_input.setText(first_json)
             self.tiff_manager.load_current()
-
-            self._clear_enhanced_grid()
-            self._add_enhanced_frame_and_grid(grid_interval=60)
-
-            self.viewer.layers.selection.clear()
-            self.viewer.layers.selection.add(self.tiff_manager.image_layer)
-
-            self.tiff_manager.image_layer.mouse_double_click_callbacks.clear()
-            self.tiff_manager.image_layer.mouse_double_click_callbacks.append(self.handle_right_click)
             self.snapshot_dir = os.path.join(new_path, 'snapshots')
             os.makedirs(self.snapshot_dir, exist_ok=True)
             # self.save_path_input.setText(current_json)
@@ -253,48 +589,106 @@ class MainApp:
 
         pos, direction = self.get_camera_ray(event)
         menu = QMenu()
-        act1 = menu.addAction("First Click")
-        act2 = menu.addAction("Second Click")
+        act1 = menu.addAction(f"Add Ray ({len(self.ray_info)} so far)")
+        act2 = menu.addAction("Add Ray and Triangulate")
+        act_clear = menu.addAction("Clear Rays")
+        act_clear.setEnabled(bool(self.ray_info))
+        act_mip = menu.addAction("Add Arrow at Brightest Point")
+        act2.setEnabled(not self.tiff_manager.is_loading)
+        act_mip.setEnabled(not self.tiff_manager.is_loading)
+        act_pick = menu.addAction("Select Nearest Arrow")
         action = menu.exec_(event.native.globalPos())
         if action == act1:
-            self.ray_info['first'] = (pos, direction)
+            self.ray_info.append((pos, direction))
         elif action == act2:
-            self.ray_info['second'] = (pos, direction)
-
-        if self.ray_info['first'] and self.ray_info['second']:
-            p1, d1 = self.ray_info['first']
-            p2, d2 = self.ray_info['second']
-            mid = self.triangulate_rays(p1, d1, p2, d2)
-
-            # image_pixel_size = (5, 0.91, 0.91)
-            # default_arrow_length = 25
-            # default_arrow_direction =  np.array([0, 1, 1])
-            # default_arrow_color = 'red'
-            # default_arrow_width = 3
-            # default_arrow_opacity = 1.0
-            target_point = mid[[2, 1, 0]]
-            direction = np.array([0, 1, 1])
-            unit_direction = direction / np.linalg.norm(direction)
-            start_point = target_point - unit_direction * default_arrow_length
+            self.ray_info.append((pos, direction))
+            self.triangulate_recorded_rays()
+        elif action == act_clear:
+            self.ray_info.clear()
+        elif action == act_mip:
+            self.add_arrow_at_brightest_point(pos, direction)
+        elif action == act_pick:
+            # 射线是 (x, y, z)，箭头是 (z, y, x)
+            hit = self.arrow_manager.pick_arrow(pos[::-1], direction[::-1], pick_radius)
+            if hit is None:
+                print(f"No arrow within {pick_radius} of the click")
+            else:
+                self.select_arrow(hit[0])
+
+    def triangulate_recorded_rays(self):
+        """
+        Least-squares point of all recorded rays; the rays are used up either
+        way, and the arrow is only added when they are not nearly parallel
+        """
+        rays, self.ray_info = self.ray_info, []
+        if len(rays) < 2:
+            print("Triangulation needs at least two rays")
+            return
+        origins, directions = (np.array(column) for column in zip(*rays))
+        point, residual, condition = triangulate(origins, directions)
+
+        # image_pixel_size = (5, 0.91, 0.91)
+        # default_arrow_length = 25
+        # default_arrow_direction =  np.array([0, 1, 1])
+        # default_arrow_color = 'red'
+        # default_arrow_width = 3
+        # default_arrow_opacity = 1.0
+        if condition > max_triangulation_condition:
+            print(f"Rays are nearly parallel (condition {condition:.0f}); "
+                  f"rotate the view further between clicks")
+            return
+        if residual > max_triangulation_residual:
+            print(f"Warning: the {len(rays)} rays miss each other by {residual:.2f} on average; "
+                  f"check the arrow")
+        self._add_arrow_at(point[[2, 1, 0]])
 
-            if mid is not None:
-                self.arrow_manager.add_arrow(
-                    start=start_point,
-                    direction=unit_direction * default_arrow_length,
-                    color=default_arrow_color,
-                    width=default_arrow_width,
-                    opacity=default_arrow_opacity)
+    def add_arrow_at_brightest_point(self, pos, direction):
+        """
+        One-click alternative to First/Second Click: the arrow points at the
+        brightest voxel along the viewing ray, as shown by 'mip' rendering
+        """
+        volume = self.tiff_manager.volume
+        if volume is None:
+            return
+        # 射线是 (x, y, z)，体数据是 (z, y, x)
+        hit = pick_max_along_ray(volume, image_pixel_size, pos[::-1], direction[::-1])
+        if hit is None:
+            print("The click ray does not cross the volume")
+            return
+        self._add_arrow_at(hit[0])
 
-                self.viewer.layers.selection.clear()
-                self.viewer.layers.selection.add(self.tiff_manager.image_layer)
+    def _add_arrow_at(self, target_point):
+        """Add a default arrow ending at target_point (z, y, x), unless one already ends there"""
+        if self._refuse_while_loading():
+            return
+        volume = self.tiff_manager.volume
+        if refine_picks and volume is not None:
+            # 吸附到附近的亮度中心（亚体素精度）
+            target_point = refine_point(volume, image_pixel_size, target_point, refine_radius)
+        duplicate = self.arrow_manager.find_duplicate(target_point, duplicate_radius)
+        if duplicate is not None:
+            # 已有箭头指向这里：选中它而不是重复添加
+            print(f"An arrow already ends within {duplicate_radius} of this point (row {duplicate + 1})")
+            self.select_arrow(duplicate)
+        else:
+            unit_direction = self._arrow_directions(target_point, auto_orient)[0]
+            start_point = target_point - unit_direction * default_arrow_length
+            self.arrow_manager.add_arrow(
+                start=start_point,
+                direction=unit_direction * default_arrow_length,
+                color=default_arrow_color,
+                width=default_arrow_width,
+                opacity=default_arrow_opacity)
 
-            self.ray_info['first'] = None
-            self.ray_info['second'] = None
+        self.viewer.layers.selection.clear()
+        self.viewer.layers.selection.add(self.tiff_manager.image_layer)
 
     def get_camera_ray(self, event):
         """
         Get the function of a space line: p0 + t * dir t \in (-\infty, +\infty)
         based on the location where the mouse is clicked
+        The line is in world (physical) coordinates, which do not depend on
+        which pyramid level of a multiscale image is being displayed
         :return near: the coordinate of p0 (x,y,z)
         :return dir / np.linalg.norm(dir): the normalized direction of the line (x,y,z)
         """
@@ -311,14 +705,11 @@ class MainApp:
     def triangulate_rays(self, p1, d1, p2, d2):
         """
         Get the coordinates of the closest point between two non-coplanar lines
+        (see triangulation.triangulate for any number of rays)
         """
-        w0 = p1 - p2
-        a, b, c = np.dot(d1, d1), np.dot(d1, d2), np.dot(d2, d2)
-        d, e = np.dot(d1, w0), np.dot(d2, w0)
-        denom = a * c - b * b
-        if np.isclose(denom, 0): return None
-        t, s = (b * e - c * d) / denom, (a * e - b * d) / denom
-        return (p1 + t * d1 + p2 + s * d2) / 2
+        point, _, condition = triangulate([p1, p2], [d1, d2])
+        if condition > max_triangulation_condition: return None
+        return point
 
     # def _add_volume_bounding_box(self):
     #     from main_app import image_pixel_size
@@ -363,70 +754,34 @@ class MainApp:
     #         )
 
     def _add_enhanced_frame_and_grid(self, grid_interval=10):
-        """添加优化版的边框和网格，用于增强3D感知"""
+        """
+        添加边框和网格，用于增强3D感知。边框和网格是同一个 vectors 图层，
+        线段按 (shape, scale, grid_interval) 缓存；几何不变时图层原样保留
+        """
         image = self.tiff_manager.image_layer
         if image.ndim != 3:
             return
+        signature = (tuple(image.level_shapes[0]), tuple(image.scale), grid_interval)
+        layer = self._grid_layer
+        if layer is not None and layer in self.viewer.layers and signature == self._grid_signature:
+            return
 
-        scale = np.array(image.scale)
-        shape = np.array(image.data.shape)
-        z, y, x = shape * scale
-
-        # === 1. 立方体 8 顶点 ===
-        verts = np.array([
-            [0, 0, 0], [0, 0, x], [0, y, 0], [0, y, x],
-            [z, 0, 0], [z, 0, x], [z, y, 0], [z, y, x]
-        ])
-        # 12条边
-        edges = [[verts[i], verts[j]] for i, j in [
-            (0, 1), (0, 2), (1, 3), (2, 3),
-            (4, 5), (4, 6), (5, 7), (6, 7),
-            (0, 4), (1, 5), (2, 6), (3, 7)
-        ]]
-        self.viewer.add_shapes(
-            data=edges,
-            shape_type='line',
-            edge_color='white',
-            edge_width=1,
-            opacity=0.1,
-            name='Bounding Box',
-            blending='additive'
-        )
-
-        # === 2. 网格线：只绘底面和顶面两个 XY 面 ===
-        grid_lines = []
-        z_plane = z
-        for xi in np.arange(0, x + 1e-3, grid_interval):
-            grid_lines.append([[z_plane, 0, xi], [z_plane, y, xi]])
-        for yi in np.arange(0, y + 1e-3, grid_interval):
-            grid_lines.append([[z_plane, yi, 0], [z_plane, yi, x]])
-
-        for x_plane in [0, x]:
-            for zi in np.arange(0, z + 1e-3, grid_interval):
-                grid_lines.append([[zi, 0, x_plane], [zi, y, x_plane]])
-            for yi in np.arange(0, y + 1e-3, grid_interval):
-                grid_lines.append([[0, yi, x_plane], [z, yi, x_plane]])
-
-        for y_plane in [0, y]:
-            for zi in np.arange(0, z + 1e-3, grid_interval):
-                grid_lines.append([[zi, y_plane, 0], [zi, y_plane, x]])
-            for xi in np.arange(0, x + 1e-3, grid_interval):
-                grid_lines.append([[0, y_plane, xi], [z, y_plane, xi]])
-
-        self.viewer.add_shapes(
-            data=grid_lines,
-            shape_type='line',
-            edge_color='white',
-            edge_width=0.8,
-            opacity=0.04,
-            name='Grid XY Planes',
-            blending='translucent'
-        )
-
-    def _clear_enhanced_grid(self):
-        for name in ['Bounding Box', 'Grid XY Planes']:
-            if name in self.viewer.layers:
-                self.viewer.layers.remove(name)
+        vectors, is_box, _ = frame_and_grid(*signature, max_lines=max_grid_lines)
+        # 边框比网格更亮：逐线 RGBA 代替两个图层各自的 opacity
+        colors = np.where(is_box[:, None], [[1, 1, 1, 0.1]], [[1, 1, 1, 0.04]])
+        if layer is not None and layer in self.viewer.layers:
+            layer.data = vectors
+            layer.edge_color = colors
+        else:
+            self._grid_layer = self.viewer.add_vectors(
+                vectors,
+                edge_color=colors,
+                edge_width=1,
+                vector_style='line',
+                name='Frame and Grid',
+                blending='translucent'
+            )
+        self._grid_signature = signature
 
 if __name__ == '__main__':
     app = MainApp()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+picking.py : Single-click 3D picking by ray-marching the displayed volume
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module turns one viewing ray into a 3D point, the way the 'mip'
+    rendering of the image layer does: the ray is clipped to the volume's
+    physical bounding box, intensities are sampled along it with vectorized
+    trilinear interpolation, and the brightest sample is returned.
+"""
+
+import numpy as np
+
+
+def clip_ray_to_box(origin, direction, lo, hi):
+    """
+    Slab test of the line origin + t * direction against the box [lo, hi]
+    :return: (t_enter, t_exit), or None if the line misses the box
+    """
+    origin = np.asarray(origin, dtype=float)
+    direction = np.asarray(direction, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (np.asarray(lo, dtype=float) - origin) / direction
+        t2 = (np.asarray(hi, dtype=float) - origin) / direction
+    t_near, t_far = np.fmin(t1, t2), np.fmax(t1, t2)
+    # 与某轴平行的射线：在该轴范围内则不限制，否则不相交
+    parallel = direction == 0
+    inside = (origin >= lo) & (origin <= hi)
+    if (parallel & ~inside).any():
+        return None
+    t_near[parallel], t_far[parallel] = -np.inf, np.inf
+    t_enter, t_exit = t_near.max(), t_far.min()
+    if t_enter > t_exit:
+        return None
+    return t_enter, t_exit
+
+
+def trilinear(volume, coords):
+    """
+    Sample a volume at fractional voxel coordinates (N, 3) (z, y, x); the
+    coordinates must lie within [0, shape - 1]
+    """
+    coords = np.asarray(coords, dtype=float)
+    shape = np.array(volume.shape[-3:])
+    base = np.clip(np.floor(coords).astype(int), 0, np.maximum(shape - 2, 0))
+    frac = coords - base
+    if not isinstance(volume, np.ndarray):
+        # 懒加载（zarr 等）不支持花式索引：只读出射线经过的包围盒
+        lo, hi = base.min(axis=0), np.minimum(base.max(axis=0) + 2, shape)
+        volume = np.asarray(volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+        base = base - lo
+    top = np.minimum(base + 1, np.array(volume.shape) - 1)
+    z0, y0, x0 = base.T
+    z1, y1, x1 = top.T
+    fz, fy, fx = frac.T
+    c00 = volume[z0, y0, x0] * (1 - fx) + volume[z0, y0, x1] * fx
+    c01 = volume[z0, y1, x0] * (1 - fx) + volume[z0, y1, x1] * fx
+    c10 = volume[z1, y0, x0] * (1 - fx) + volume[z1, y0, x1] * fx
+    c11 = volume[z1, y1, x0] * (1 - fx) + volume[z1, y1, x1] * fx
+    c0 = c00 * (1 - fy) + c01 * fy
+    c1 = c10 * (1 - fy) + c11 * fy
+    return c0 * (1 - fz) + c1 * fz
+
+
+def sample_ray(volume, scale, origin, direction, step=None):
+    """
+    Intensities along a line of sight through a volume of voxel size scale;
+    like 'mip' rendering, the whole line is used, whichever side of origin
+    :param origin, direction: the ray in physical (z, y, x) coordinates
+    :param step: sampling step in physical units (default: half the finest voxel size)
+    :return: (N, 3) physical sample positions and (N,) intensities, or None
+        if the ray misses the volume
+    """
+    scale = np.asarray(scale, dtype=float)
+    direction = np.asarray(direction, dtype=float)
+    direction = direction / np.linalg.norm(direction)
+    hi = (np.array(volume.shape[-3:]) - 1) * scale
+    span = clip_ray_to_box(origin, direction, np.zeros(3), hi)
+    if span is None:
+        return None
+    if step is None:
+        step = scale.min() / 2
+    t = np.arange(span[0], span[1] + step / 2, step)
+    points = np.asarray(origin, dtype=float) + t[:, None] * direction
+    coords = np.clip(points / scale, 0, np.array(volume.shape[-3:]) - 1)
+    return points, trilinear(volume, coords)
+
+
+def pick_max_along_ray(volume, scale, origin, direction, step=None):
+    """
+    Point of maximum intensity along a viewing ray, as seen in 'mip' rendering
+    :return: (physical (z, y, x) point, intensity), or None if the ray misses the volume
+    """
+    samples = sample_ray(volume, scale, origin, direction, step)
+    if samples is None:
+        return None
+    points, values = samples
+    best = int(np.argmax(values))
+    return points[best], float(values[best])
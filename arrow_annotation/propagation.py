@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+propagation.py : Tracking of arrow targets from one timepoint to the next
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module finds where the neighbourhood of each arrow target of one
+    stack has moved to in the next stack, by local normalized cross-
+    correlation. A template around every target and a larger search window
+    in the next stack are gathered for all targets at once; the
+    correlations are computed with batched FFTs, normalized with box sums
+    from cumulative sums, and the peaks are refined to sub-voxel precision.
+    The peak correlation is returned as a confidence score.
+"""
+
+import numpy as np
+
+from orientation import gather_windows
+
+
+def _box_sums(data, size):
+    """Sums of data (N, Z, Y, X) over every box of shape size that fits in it"""
+    out = data
+    for axis, n in enumerate(size, start=1):
+        total = np.cumsum(out, axis=axis)
+        pad = [(0, 0)] * out.ndim
+        pad[axis] = (1, 0)
+        total = np.pad(total, pad)
+        length = total.shape[axis] - n
+        upper = [slice(None)] * out.ndim
+        lower = [slice(None)] * out.ndim
+        upper[axis] = slice(n, n + length)
+        lower[axis] = slice(0, length)
+        out = total[tuple(upper)] - total[tuple(lower)]
+    return out
+
+
+def normalized_cross_correlation(templates, searches):
+    """
+    NCC of each template (N, t...) at every position fully inside its search
+    window (N, s...)
+    :return: (N, s - t + 1 ...) correlation coefficients in [-1, 1]
+    """
+    templates = templates - templates.mean(axis=(1, 2, 3), keepdims=True)
+    t_shape, s_shape = templates.shape[1:], searches.shape[1:]
+    # 循环相关：模板补零到搜索窗大小，偏移 0..s-t 处没有回绕
+    spectrum = np.fft.rfftn(searches, axes=(1, 2, 3)) * np.conj(
+        np.fft.rfftn(templates, s=s_shape, axes=(1, 2, 3)))
+    correlation = np.fft.irfftn(spectrum, s=s_shape, axes=(1, 2, 3))
+    valid = tuple(slice(0, s - t + 1) for s, t in zip(s_shape, t_shape))
+    numerator = correlation[(slice(None),) + valid]
+
+    count = np.prod(t_shape)
+    sums = _box_sums(searches.astype(np.float64), t_shape)
+    squares = _box_sums(searches.astype(np.float64) ** 2, t_shape)
+    search_energy = np.maximum(squares - sums ** 2 / count, 0)
+    template_energy = (templates ** 2).sum(axis=(1, 2, 3))
+    denominator = np.sqrt(search_energy * template_energy[:, None, None, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, 0)
+
+
+def _subvoxel_peaks(scores):
+    """Peak positions (N, 3) of scores (N, Z, Y, X), refined per axis by a parabola"""
+    n = len(scores)
+    flat = scores.reshape(n, -1).argmax(axis=1)
+    peaks = np.stack(np.unravel_index(flat, scores.shape[1:]), axis=1)
+    refined = peaks.astype(float)
+    rows = np.arange(n)
+    for axis in range(3):
+        size = scores.shape[axis + 1]
+        inner = (peaks[:, axis] > 0) & (peaks[:, axis] < size - 1)
+        before, after = peaks.copy(), peaks.copy()
+        before[:, axis] = np.maximum(peaks[:, axis] - 1, 0)
+        after[:, axis] = np.minimum(peaks[:, axis] + 1, size - 1)
+        a = scores[(rows, *before.T)]
+        b = scores[(rows, *peaks.T)]
+        c = scores[(rows, *after.T)]
+        curvature = a - 2 * b + c
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift = np.where(inner & (curvature < 0), 0.5 * (a - c) / curvature, 0)
+        refined[:, axis] += np.clip(shift, -0.5, 0.5)
+    return refined, scores.reshape(n, -1).max(axis=1)
+
+
+def track_targets(volume, next_volume, scale, targets, patch_radius, search_radius, batch=256,
+                  guesses=None):
+    """
+    :param volume, next_volume: consecutive (Z, Y, X) stacks of the same shape
+    :param scale: physical voxel size (z, y, x)
+    :param targets: (N, 3) physical arrow ends (z, y, x) in volume
+    :param patch_radius: physical half size of the template around each target
+    :param search_radius: largest physical displacement looked for along each axis
+    :param batch: targets correlated per FFT call, bounding the memory used
+    :param guesses: (N, 3) physical positions in next_volume around which to
+        search (e.g. targets corrected for the global drift); targets by default
+    :return: (N, 3) physical targets in next_volume and (N,) confidences (peak
+        NCC); targets without any positive correlation stay at their guess
+    """
+    scale = np.asarray(scale, dtype=float)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+    guesses = targets if guesses is None else np.asarray(guesses, dtype=float).reshape(-1, 3)
+    template_half = np.maximum(np.ceil(patch_radius / scale).astype(int), 1)
+    search_half = template_half + np.ceil(search_radius / scale).astype(int)
+    moved = np.empty_like(targets)
+    confidences = np.empty(len(targets))
+    for first in range(0, len(targets), batch):
+        part = slice(first, first + batch)
+        centers = np.round(guesses[part] / scale)
+        templates = gather_windows(volume, np.round(targets[part] / scale), template_half)
+        searches = gather_windows(next_volume, centers, search_half)
+        scores = normalized_cross_correlation(templates, searches)
+        peaks, confidences[part] = _subvoxel_peaks(scores)
+        # 偏移 search_half - template_half 处表示没有移动
+        shift = peaks - (search_half - template_half)
+        moved[part] = (centers + shift) * scale
+    # 模板中心取整到体素，这里把取整误差加回去
+    moved += targets - np.round(targets / scale) * scale
+    # 没有任何正相关（如平坦区域）时峰的位置没有意义，留在原处
+    moved[confidences <= 0] = guesses[confidences <= 0]
+    return moved, confidences
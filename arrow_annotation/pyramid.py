@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+pyramid.py : Anisotropy-aware multiscale pyramids for large TIFF stacks
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module builds downsampled levels of a volume for napari's multiscale
+    image display. Each level halves the finest physical axes first, so the
+    in-plane axes of an FLFM reconstruction are reduced before the coarse Z
+    axis, and every reduction is a box (block-mean) filter to avoid aliasing.
+"""
+
+import numpy as np
+
+
+def fits(shape, itemsize, max_bytes=None, max_size=None):
+    """Whether a level of this shape fits the byte budget and the texture size limit"""
+    return ((max_bytes is None or int(np.prod(shape)) * itemsize <= max_bytes)
+            and (max_size is None or max(shape) <= max_size))
+
+
+def level_factors(scale, shape, min_size=256, max_levels=6, itemsize=1, max_bytes=None, max_size=None):
+    """
+    Per-level downsampling factors (one int per axis) for a volume of the given
+    physical voxel size: at every level, axes whose spacing is less than twice
+    the current finest spacing are halved, as long as they stay >= min_size.
+    With max_bytes / max_size, stops at the first level that fits them, since
+    napari renders only the coarsest level in 3D
+    """
+    spacing = np.asarray(scale, dtype=float).copy()
+    shape = np.asarray(shape).copy()
+    factors = []
+    for _ in range(max_levels - 1):
+        factor = np.where((spacing < 2 * spacing.min()) & (shape // 2 >= min_size), 2, 1)
+        if not (factor > 1).any():
+            break
+        factors.append(factor)
+        spacing *= factor
+        shape = shape // factor
+        if (max_bytes is not None or max_size is not None) and fits(shape, itemsize, max_bytes, max_size):
+            break
+    return factors
+
+
+def downsample(volume, factor):
+    """
+    Block-mean downsampling by integer factors, one axis at a time so that no
+    full-size temporary is made; a trailing odd voxel is dropped
+    """
+    out = volume
+    for axis, f in enumerate(factor):
+        if f == 1:
+            continue
+        m = out.shape[axis] // f * f
+        parts = [out[(slice(None),) * axis + (slice(k, m, f),)] for k in range(f)]
+        acc = np.add(parts[0], parts[1], dtype=np.float32)
+        for part in parts[2:]:
+            acc += part
+        acc /= f
+        out = acc
+    if out is volume:
+        return np.asarray(volume)
+    if np.issubdtype(volume.dtype, np.integer):
+        np.rint(out, out=out)
+    return out.astype(volume.dtype)
+
+
+def build_pyramid(volume, scale, min_size=256, max_levels=6, max_bytes=None, max_size=None):
+    """
+    :param max_bytes, max_size: stop at the first level within these (see level_factors)
+    :return: [volume, level1, level2, ...] from full to coarsest resolution;
+        just [volume] when the volume is too small to be worth a pyramid
+    """
+    levels = [volume]
+    for factor in level_factors(scale, volume.shape, min_size, max_levels,
+                                volume.dtype.itemsize, max_bytes, max_size):
+        levels.append(downsample(levels[-1], factor))
+    return levels
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+refinement.py : Sub-voxel refinement of picked points to the local intensity peak
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module moves a picked point (physical z, y, x) to the intensity-
+    weighted centroid of the bright part of a small neighbourhood around it.
+    The neighbourhood has the same physical radius along every axis, so it
+    spans fewer voxels along the coarse Z axis, and it is read as a cropped
+    view of the stack; the window is re-centred until the centroid settles.
+"""
+
+import numpy as np
+
+
+def crop_around(volume, center, half):
+    """
+    View (not a copy, for in-memory and memory-mapped stacks) of the voxels
+    within half voxels of center along each axis
+    :return: the crop and the voxel index of its first corner
+    """
+    shape = np.array(volume.shape[-3:])
+    lo = np.clip(np.round(center).astype(int) - half, 0, shape - 1)
+    hi = np.clip(np.round(center).astype(int) + half + 1, 1, shape)
+    return volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]], lo
+
+
+def weighted_centroid(crop, level=0.5):
+    """
+    Intensity-weighted centroid (voxel units, relative to the crop) of the
+    voxels brighter than min + level * (max - min); None for a flat crop
+    """
+    crop = np.asarray(crop, dtype=np.float32)
+    low, high = crop.min(), crop.max()
+    if high <= low:
+        return None
+    weights = np.clip(crop - (low + level * (high - low)), 0, None)
+    total = weights.sum()
+    grids = np.ogrid[:crop.shape[0], :crop.shape[1], :crop.shape[2]]
+    return np.array([(weights * g).sum() / total for g in grids])
+
+
+def refine_point(volume, scale, point, radius, level=0.5, iterations=3):
+    """
+    :param scale: physical voxel size (z, y, x)
+    :param point: picked point in physical (z, y, x) coordinates
+    :param radius: half size of the search window in physical units
+    :param level: fraction between the window minimum and maximum below which
+        voxels are ignored, so the background does not pull the centroid
+    :return: refined physical point; the input point when the window is flat,
+        outside the stack or the peak drifted out of the first window
+    """
+    scale = np.asarray(scale, dtype=float)
+    point = np.asarray(point, dtype=float)
+    half = np.maximum(np.ceil(radius / scale).astype(int), 1)
+    start = center = point / scale
+    for _ in range(iterations):
+        crop, lo = crop_around(volume, center, half)
+        if min(crop.shape) == 0:
+            return point
+        centroid = weighted_centroid(crop, level)
+        if centroid is None:
+            return point
+        moved = np.abs(lo + centroid - center).max()
+        center = lo + centroid
+        if moved < 0.5:
+            break
+    if (np.abs(center - start) > half).any():
+        return point
+    return center * scale
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+registration.py : Rigid drift registration between stacks by phase correlation
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module estimates the rigid motion of the sample between two stacks:
+    a 3D translation from phase correlation of block-averaged, windowed
+    volumes, optionally preceded by a rotation about the Z axis found by a
+    batched search over rotated maximum intensity projections. A transform
+    is a JSON-friendly dict mapping physical points (z, y, x) of the first
+    stack to the second, p' = R(angle) (p - center) + center + translation,
+    with R rotating in the YX plane; transforms can be inverted, composed
+    and applied to arrows, and a folder of stacks can be registered once,
+    its transforms kept in the folder index.
+"""
+
+import numpy as np
+
+from pyramid import downsample
+
+
+def _rotation(angle):
+    """3x3 rotation by angle (degrees) in the YX plane of (z, y, x) vectors"""
+    a = np.radians(angle)
+    return np.array([[1, 0, 0],
+                     [0, np.cos(a), -np.sin(a)],
+                     [0, np.sin(a), np.cos(a)]])
+
+
+def apply_transform(transform, points, directions=None):
+    """
+    Map physical points (N, 3) of the first stack into the second; directions,
+    if given, are rotated only
+    """
+    rotation = _rotation(transform['angle'])
+    center = np.asarray(transform['center'], dtype=float)
+    points = (np.asarray(points, dtype=float) - center) @ rotation.T + center + transform['translation']
+    if directions is None:
+        return points
+    return points, np.asarray(directions, dtype=float) @ rotation.T
+
+
+def invert_transform(transform):
+    rotation = _rotation(transform['angle'])
+    return {'angle': -transform['angle'], 'center': list(transform['center']),
+            'translation': (-rotation.T @ np.asarray(transform['translation'])).tolist(),
+            'score': transform['score']}
+
+
+def compose_transforms(first, second):
+    """Transform equivalent to applying first, then second (both about first's center)"""
+    center = np.asarray(first['center'], dtype=float)
+    # 把 second 的旋转中心换到 first 的中心上
+    shift = apply_transform(second, center) - center
+    rotation = _rotation(second['angle'])
+    translation = rotation @ np.asarray(first['translation']) + shift
+    return {'angle': first['angle'] + second['angle'], 'center': center.tolist(),
+            'translation': translation.tolist(), 'score': min(first['score'], second['score'])}
+
+
+def _hann(shape):
+    window = np.ones(shape, dtype=np.float32)
+    for axis, n in enumerate(shape):
+        w = np.hanning(n).astype(np.float32) if n > 2 else np.ones(n, dtype=np.float32)
+        window *= w.reshape([-1 if a == axis else 1 for a in range(len(shape))])
+    return window
+
+
+def _prepare(volume, max_size):
+    """Block-averaged, zero-mean and Hann-windowed copy; returns it and the factors"""
+    shape = np.array(volume.shape[-3:])
+    factor = np.maximum(np.ceil(shape / max_size).astype(int), 1)
+    small = downsample(np.asarray(volume), factor).astype(np.float32)
+    small -= small.mean()
+    small *= _hann(small.shape)
+    return small, factor
+
+
+def phase_correlation(a, b, axes):
+    """
+    Shift s (one value per axis, sub-voxel) such that b(x) ~ a(x - s), and the
+    height of the correlation peak; leading axes not in axes are batched
+    """
+    spectrum = np.fft.fftn(b, axes=axes) * np.conj(np.fft.fftn(a, axes=axes))
+    spectrum /= np.abs(spectrum) + 1e-12
+    surface = np.fft.ifftn(spectrum, axes=axes).real
+    batch = surface.shape[:surface.ndim - len(axes)]
+    flat = surface.reshape(batch + (-1,))
+    best = flat.argmax(axis=-1)
+    peaks = np.stack(np.unravel_index(best, surface.shape[-len(axes):]), axis=-1)
+    heights = np.take_along_axis(flat, best[..., None], axis=-1)[..., 0]
+    shifts = peaks.astype(float)
+    for k, n in enumerate(surface.shape[-len(axes):]):
+        # 抛物线插值，邻点按周期取
+        before, after = peaks.copy(), peaks.copy()
+        before[..., k] = (peaks[..., k] - 1) % n
+        after[..., k] = (peaks[..., k] + 1) % n
+        lo = surface[(*np.indices(batch), *np.moveaxis(before, -1, 0))] if batch else surface[tuple(before)]
+        hi = surface[(*np.indices(batch), *np.moveaxis(after, -1, 0))] if batch else surface[tuple(after)]
+        curvature = lo - 2 * heights + hi
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(curvature < 0, 0.5 * (lo - hi) / curvature, 0)
+        shifts[..., k] += np.clip(delta, -0.5, 0.5) if n > 2 else 0
+        # 超过一半的位移是负向的
+        shifts[..., k] = np.where(shifts[..., k] > n / 2, shifts[..., k] - n, shifts[..., k])
+    return shifts, heights
+
+
+def rotate_yx(images, angles, spacing, center):
+    """
+    Rotate images (..., Y, X) with physical pixel size spacing (y, x) by each
+    of angles (degrees) about the physical point center (y, x), bilinearly
+    :return: (len(angles), ..., Y, X)
+    """
+    ny, nx = images.shape[-2:]
+    y = np.arange(ny) * spacing[0] - center[0]
+    x = np.arange(nx) * spacing[1] - center[1]
+    yy, xx = np.meshgrid(y, x, indexing='ij')
+    out = []
+    for angle in np.atleast_1d(angles):
+        # 输出点 p 取自原图的 R^-1 p
+        a = np.radians(angle)
+        sy = (np.cos(a) * yy + np.sin(a) * xx + center[0]) / spacing[0]
+        sx = (-np.sin(a) * yy + np.cos(a) * xx + center[1]) / spacing[1]
+        inside = (sy >= 0) & (sy <= ny - 1) & (sx >= 0) & (sx <= nx - 1)
+        y0 = np.clip(np.floor(sy).astype(int), 0, max(ny - 2, 0))
+        x0 = np.clip(np.floor(sx).astype(int), 0, max(nx - 2, 0))
+        fy, fx = sy - y0, sx - x0
+        y1, x1 = np.minimum(y0 + 1, ny - 1), np.minimum(x0 + 1, nx - 1)
+        top = images[..., y0, x0] * (1 - fx) + images[..., y0, x1] * fx
+        bottom = images[..., y1, x0] * (1 - fx) + images[..., y1, x1] * fx
+        out.append(np.where(inside, top * (1 - fy) + bottom * fy, 0).astype(np.float32))
+    return np.stack(out)
+
+
+def register(volume, next_volume, scale, max_size=128, rotation=False, max_angle=10.0, angle_step=1.0):
+    """
+    :param scale: physical voxel size (z, y, x)
+    :param max_size: largest size per axis of the block-averaged volumes correlated
+    :param rotation: also search a rotation about Z within +-max_angle degrees
+    :return: transform dict mapping physical points of volume into next_volume;
+        'score' is the phase-correlation peak height (higher is more reliable)
+    """
+    scale = np.asarray(scale, dtype=float)
+    a, factor = _prepare(volume, max_size)
+    b, _ = _prepare(next_volume, max_size)
+    spacing = scale * factor
+    # 块平均后体素 i 的中心在原体素 i * factor + (factor - 1) / 2 处
+    origin = (factor - 1) / 2 * scale
+    center = origin + (np.array(a.shape) - 1) / 2 * spacing
+    angle = 0.0
+    if rotation:
+        angles = np.arange(-max_angle, max_angle + angle_step / 2, angle_step)
+        mips = rotate_yx(a.max(axis=0), angles, spacing[1:], center[1:] - origin[1:])
+        _, heights = phase_correlation(mips, np.broadcast_to(b.max(axis=0), mips.shape), axes=(1, 2))
+        best = int(np.argmax(heights))
+        angle = float(angles[best])
+        if 0 < best < len(angles) - 1:
+            lo, mid, hi = heights[best - 1:best + 2]
+            curvature = lo - 2 * mid + hi
+            if curvature < 0:
+                angle += float(np.clip(0.5 * (lo - hi) / curvature, -0.5, 0.5) * angle_step)
+        a = rotate_yx(a, [angle], spacing[1:], center[1:] - origin[1:])[0]
+    shift, height = phase_correlation(a, b, axes=(0, 1, 2))
+    shift = shift * factor
+    if (factor > 1).any():
+        shift = _refine_shift(volume, next_volume, scale, shift, factor, max_size, angle, center)
+    return {'angle': angle, 'center': center.tolist(),
+            'translation': (shift * scale).tolist(), 'score': float(height)}
+
+
+def _refine_shift(volume, next_volume, scale, shift, factor, max_size, angle, center):
+    """
+    Full-resolution correction of a coarse shift (voxels) from central crops of
+    at most max_size voxels per axis; the coarse shift is kept if the correction
+    exceeds one coarse voxel
+    """
+    shape = np.array(volume.shape[-3:])
+    half = np.minimum(max_size // 2, shape // 2)
+    lo = shape // 2 - half
+    lo_next = np.clip(lo + np.round(shift).astype(int), 0, shape - 2 * half)
+    crop = np.asarray(volume[tuple(slice(l, l + 2 * h) for l, h in zip(lo, half))], dtype=np.float32)
+    crop_next = next_volume[tuple(slice(l, l + 2 * h) for l, h in zip(lo_next, half))]
+    if angle:
+        crop = rotate_yx(crop, [angle], scale[1:], center[1:] - lo[1:] * scale[1:])[0]
+    a, _ = _prepare(crop, max_size)
+    b, _ = _prepare(crop_next, max_size)
+    residual, _ = phase_correlation(a, b, axes=(0, 1, 2))
+    refined = lo_next - lo + residual
+    if (np.abs(refined - shift) > factor).any():
+        return shift
+    return refined
+
+
+def register_folder(files, scale, folder_index, read=None, **kwargs):
+    """
+    Register every pair of consecutive stacks, reusing transforms cached in
+    folder_index (see FolderIndex.get_registration) and storing new ones
+    :param read: function reading a stack (default tifffile.imread)
+    :return: list of len(files) - 1 transforms, files[i] -> files[i + 1]
+    """
+    if read is None:
+        import tifffile
+        read = tifffile.imread
+    transforms = []
+    previous = None
+    for file_a, file_b in zip(files, files[1:]):
+        transform = folder_index.get_registration(file_a, file_b, kwargs)
+        if transform is None:
+            volume = previous if previous is not None else read(file_a)
+            previous = read(file_b)
+            transform = register(volume, previous, scale, **kwargs)
+            folder_index.put_registration(file_a, file_b, kwargs, transform)
+        else:
+            previous = None
+        transforms.append(transform)
+    return transforms
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    from folder_index import FolderIndex
+    parser = argparse.ArgumentParser(description="Register consecutive TIFF stacks of a folder")
+    parser.add_argument('folder')
+    parser.add_argument('--scale', type=float, nargs=3, default=(5, 0.91, 0.91), help="voxel size z y x")
+    parser.add_argument('--rotation', action='store_true', help="also estimate a rotation about Z")
+    args = parser.parse_args()
+    index = FolderIndex(args.folder)
+    index.update()
+    files = index.files()
+    for (a, b), t in zip(zip(files, files[1:]),
+                         register_folder(files, args.scale, index, rotation=args.rotation)):
+        print(f"{os.path.basename(a)} -> {os.path.basename(b)}: "
+              f"translation {np.round(t['translation'], 2).tolist()}, angle {t['angle']:.2f}, "
+              f"score {t['score']:.3f}")
+    index.close()
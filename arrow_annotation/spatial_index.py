@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+spatial_index.py : Uniform-grid spatial hash over 3D points in physical units
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module defines a SpatialIndex class that buckets 3D points (arrow
+    ends or starts, keyed by arrow row) into cubic cells of a fixed physical
+    size. Inserts (re-inserting a key moves it) and deletes touch one cell;
+    radius, nearest neighbour and nearest-to-ray queries only look at the
+    cells they overlap.
+"""
+
+import numpy as np
+
+
+class SpatialIndex:
+    def __init__(self, cell_size=20.0):
+        self.cell_size = float(cell_size)
+        self._cells = {}
+        self._points = {}
+        # 已占用格子的 (keys, centers) 缓存，格子集合变化时作废
+        self._occupied = None
+        self._lo = np.full(3, np.inf)
+        self._hi = np.full(3, -np.inf)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _cell(self, point):
+        return tuple(np.floor(np.asarray(point, dtype=float) / self.cell_size).astype(int).tolist())
+
+    def insert(self, key, point):
+        point = np.asarray(point, dtype=float)
+        if key in self._points:
+            self.remove(key)
+        cell = self._cell(point)
+        if cell not in self._cells:
+            self._cells[cell] = set()
+            self._occupied = None
+        self._cells[cell].add(key)
+        self._points[key] = (cell, point)
+        self._lo = np.minimum(self._lo, point)
+        self._hi = np.maximum(self._hi, point)
+
+    def remove(self, key):
+        cell, _ = self._points.pop(key)
+        members = self._cells[cell]
+        members.discard(key)
+        if not members:
+            del self._cells[cell]
+            self._occupied = None
+
+    def clear(self):
+        self._cells.clear()
+        self._points.clear()
+        self._occupied = None
+        self._lo = np.full(3, np.inf)
+        self._hi = np.full(3, -np.inf)
+
+    def rebuild(self, points, keys=None):
+        """Replace the content with points (N, 3), keyed by keys (default 0..N-1)"""
+        self.clear()
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if keys is None:
+            keys = range(len(points))
+        cells = np.floor(points / self.cell_size).astype(int).tolist()
+        for key, cell, point in zip(keys, cells, points):
+            cell = tuple(cell)
+            self._cells.setdefault(cell, set()).add(key)
+            self._points[key] = (cell, point)
+        if len(points):
+            self._lo, self._hi = points.min(axis=0), points.max(axis=0)
+
+    def _gather(self, cell_lo, cell_hi):
+        """Keys and points of all entries in the inclusive cell range"""
+        keys = []
+        extent = np.asarray(cell_hi) - np.asarray(cell_lo) + 1
+        if extent.prod() > len(self._cells):
+            # 查询范围比已占用的格子还多：直接遍历已占用的格子
+            for cell, members in self._cells.items():
+                if all(lo <= c <= hi for c, lo, hi in zip(cell, cell_lo, cell_hi)):
+                    keys.extend(members)
+        else:
+            for z in range(cell_lo[0], cell_hi[0] + 1):
+                for y in range(cell_lo[1], cell_hi[1] + 1):
+                    for x in range(cell_lo[2], cell_hi[2] + 1):
+                        members = self._cells.get((z, y, x))
+                        if members:
+                            keys.extend(members)
+        if not keys:
+            return np.empty(0, dtype=object), np.empty((0, 3))
+        return np.array(keys, dtype=object), np.array([self._points[k][1] for k in keys])
+
+    def query_radius(self, point, radius):
+        """(keys, distances) of all points within radius of point, nearest first"""
+        point = np.asarray(point, dtype=float)
+        keys, points = self._gather(self._cell(point - radius), self._cell(point + radius))
+        dist = np.linalg.norm(points - point, axis=1)
+        order = np.argsort(dist[dist <= radius])
+        return keys[dist <= radius][order].tolist(), dist[dist <= radius][order]
+
+    def nearest(self, point, max_distance=None):
+        """(key, distance) of the nearest point, or None if none within max_distance"""
+        if not self._points:
+            return None
+        point = np.asarray(point, dtype=float)
+        if max_distance is None:
+            # 最远也不会超过到包围盒最远角的距离
+            max_distance = float(np.linalg.norm(np.maximum(abs(self._hi - point), abs(self._lo - point))))
+        radius = self.cell_size
+        while True:
+            keys, dist = self.query_radius(point, min(radius, max_distance))
+            if keys:
+                return keys[0], float(dist[0])
+            if radius >= max_distance:
+                return None
+            radius *= 2
+
+    def nearest_to_ray(self, origin, direction, max_distance):
+        """
+        (key, distance) of the point closest to the ray origin + t * direction
+        (t >= 0) among points within max_distance of it, preferring points
+        nearer the origin on ties; None if there is none
+        """
+        if not self._points:
+            return None
+        origin = np.asarray(origin, dtype=float)
+        direction = np.asarray(direction, dtype=float)
+        direction = direction / np.linalg.norm(direction)
+        # 先按格子中心到射线的距离筛格子（放宽半个格子对角线），再精确计算
+        if self._occupied is None:
+            cells = list(self._cells)
+            self._occupied = cells, (np.array(cells, dtype=float) + 0.5) * self.cell_size
+        cells, centers = self._occupied
+        t = np.clip((centers - origin) @ direction, 0, None)
+        dist = np.linalg.norm(centers - (origin + t[:, None] * direction), axis=1)
+        near = dist <= max_distance + self.cell_size * np.sqrt(3) / 2
+        keys = [k for i in np.flatnonzero(near) for k in self._cells[cells[i]]]
+        if not keys:
+            return None
+        points = np.array([self._points[k][1] for k in keys])
+        t = np.clip((points - origin) @ direction, 0, None)
+        dist = np.linalg.norm(points - (origin + t[:, None] * direction), axis=1)
+        ok = dist <= max_distance
+        if not ok.any():
+            return None
+        best = np.lexsort((t[ok], np.round(dist[ok], 6)))[0]
+        return keys[np.flatnonzero(ok)[best]], float(dist[ok][best])
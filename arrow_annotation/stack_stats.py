@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+stack_stats.py : Percentile contrast limits and intensity ranges of TIFF stacks
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module computes, once per stack, percentile-based contrast limits and
+    the intensity range from a strided subsample of the volume, so napari
+    never has to scan a full volume to guess its contrast limits.
+"""
+
+import numpy as np
+
+
+def subsample(volume, max_samples=2_000_000):
+    """Regular strided subsample of a (lazy or in-memory) volume with at most ~max_samples voxels"""
+    shape = np.array(volume.shape)
+    step = max(1, int(np.ceil((shape.prod() / max_samples) ** (1 / len(shape)))))
+    return np.asarray(volume[tuple(slice(None, None, step) for _ in shape)])
+
+
+def compute_stack_stats(volume, percentiles=(0.5, 99.9), max_samples=2_000_000):
+    """
+    :return: dict with 'contrast_limits' (lo, hi) at the given percentiles and
+        'hist_range' (data min, data max) of the subsample
+    """
+    sample = subsample(volume, max_samples).ravel()
+    lo, hi = (float(v) for v in np.percentile(sample, percentiles))
+    if hi <= lo:
+        hi = lo + 1
+    data_min, data_max = float(sample.min()), float(sample.max())
+    if data_max <= data_min:
+        data_max = data_min + 1
+    return {
+        'contrast_limits': (lo, hi),
+        'hist_range': (data_min, data_max),
+    }
@@ -18,55 +18,553 @@ Description:
 """
 
 import os
-import glob
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import tifffile
+from napari.qt.threading import create_worker
+from vector_arrow import read_arrow_file
+from folder_index import FolderIndex
+from stack_stats import compute_stack_stats
+from pyramid import build_pyramid, fits
+from registration import register, register_folder, invert_transform, compose_transforms
+from batching import suspended_repaints, timed
+from contextlib import contextmanager
+
+
+def resident_nbytes(volume):
+    """Bytes a volume keeps in RAM; memory-mapped and lazy arrays cost nothing"""
+    if isinstance(volume, (list, tuple)):
+        return sum(resident_nbytes(level) for level in volume)
+    if isinstance(volume, np.ndarray) and not isinstance(volume, np.memmap):
+        return volume.nbytes
+    return 0
+
+
+def read_lazy(file):
+    """
+    Open a stack without decoding it: memory-map uncompressed, contiguous files,
+    fall back to a zarr view on the TIFF pages, and finally to an eager read
+    """
+    try:
+        return tifffile.memmap(file, mode='r')
+    except ValueError:
+        pass
+    try:
+        import zarr
+    except ImportError:
+        return tifffile.imread(file)
+    return zarr.open(tifffile.imread(file, aszarr=True), mode='r')
+
+
+class VolumeCache:
+    """
+    Thread-safe LRU cache of decoded volumes keyed by (path, mtime),
+    bounded by the total number of bytes held (and, for memory-mapped
+    volumes that hold no bytes, by the number of open files)
+    """
+    def __init__(self, max_bytes, max_volumes=256):
+        self.max_bytes = max_bytes
+        self.max_volumes = max_volumes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._volumes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path):
+        return os.path.abspath(path), os.stat(path).st_mtime_ns
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._volumes
+
+    def __len__(self):
+        return len(self._volumes)
+
+    def get(self, key):
+        with self._lock:
+            volume = self._volumes.get(key)
+            if volume is None:
+                self.misses += 1
+                return None
+            self._volumes.move_to_end(key)
+            self.hits += 1
+            return volume
+
+    def put(self, key, volume):
+        size = resident_nbytes(volume)
+        with self._lock:
+            if key in self._volumes:
+                self.nbytes -= resident_nbytes(self._volumes.pop(key))
+            if size > self.max_bytes:
+                return
+            while self._volumes and (self.nbytes + size > self.max_bytes
+                                     or len(self._volumes) >= self.max_volumes):
+                _, evicted = self._volumes.popitem(last=False)
+                self.nbytes -= resident_nbytes(evicted)
+            self._volumes[key] = volume
+            self.nbytes += size
+
+    def clear(self):
+        with self._lock:
+            self._volumes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'volumes': len(self._volumes), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+
+def max_texture_size_3d(default=2048):
+    """Largest 3D texture side the GPU accepts; needs the Qt thread (OpenGL context)"""
+    from qtpy.QtWidgets import QApplication
+    # 没有 QApplication 时建 OpenGL 上下文会让 Qt 直接退出进程
+    if QApplication.instance() is None:
+        return default
+    try:
+        from napari._vispy.utils.gl import get_max_texture_sizes
+        return get_max_texture_sizes()[1] or default
+    except Exception:
+        return default
 
 
 class TIFFManager:
-    def __init__(self, viewer, folder_path, json_path, load_callback):
+    def __init__(self, viewer, folder_path, json_path, load_callback,
+                 prefetch_depth=2, prefetch_workers=2, cache_bytes=4 * 1024 ** 3,
+                 lazy=False, busy_callback=None, contrast_percentiles=(0.5, 99.9),
+                 scale=(1, 1, 1), multiscale_bytes=512 * 1024 ** 2, log_timings=False,
+                 registration=None, failed_callback=None):
         self.viewer = viewer
         self.folder_path = folder_path
         self.load_callback = load_callback
+        self.busy_callback = busy_callback
+        # 加载失败时以仍在显示的栈的 json 路径调用，界面据此恢复
+        self.failed_callback = failed_callback
+        self._shown_file = None
         self.files = []
         self.index = 0
         self.image_layer = None
+        self._layer_signature = None
+        # 当前栈的全分辨率数据（多尺度显示时 image_layer 只显示金字塔）
+        self.volume = None
+        self.folder_index = None
+        # 超过 multiscale_bytes 的栈按物理体素大小建金字塔，0 表示关闭
+        self.scale = tuple(scale)
+        self.multiscale_bytes = multiscale_bytes
+        self.max_texture_size = max_texture_size_3d()
+        # 最近一次各阶段耗时（毫秒），log_timings=True 时同时打印
+        self.log_timings = log_timings
+        self.timings = {}
+        # 后台预读：当前栈前后各一个，沿浏览方向再多读 prefetch_depth - 1 个
+        self.prefetch_depth = prefetch_depth
+        self._direction = 1
+        self._prefetched = {}
+        self.cache = VolumeCache(cache_bytes)
+        # 金字塔粗层单独缓存（另一半预算），不挤占体数据，也不计入其命中统计
+        self.pyramid_cache = VolumeCache(cache_bytes // 2)
+        # 每个栈的百分位对比度与数据范围：内存 + folder_index 中的持久缓存
+        self.contrast_percentiles = tuple(contrast_percentiles)
+        self._stats = {}
+        # lazy=True：内存映射打开，像素由系统页缓存按需读入
+        self.lazy = lazy
+        # 异步加载：同一时间只有一个栈在解码，过期的请求直接丢弃
+        self._load_token = 0
+        self._load_worker = None
+        self._load_wanted = False
+        # registration 不为 None 时（register 的参数），预读后在后台配准相邻栈
+        self.registration = registration
+        self._transforms = {}
+        self._registering = set()
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers,
+                                            thread_name_prefix='tiff-prefetch')
         self.reload_file_list()
-        self.json_path = json_path
+        self.json_path = json_path or self.get_current_json_path()
 
     def reload_file_list(self):
-        self.files = sorted(glob.glob(os.path.join(self.folder_path, '*.tif')) +
-                            glob.glob(os.path.join(self.folder_path, '*.tiff')))
+        if self.folder_index is None or self.folder_index.folder_path != self.folder_path:
+            if self.folder_index is not None:
+                self.folder_index.close()
+            self.folder_index = FolderIndex(self.folder_path)
+        self.folder_index.update()
+        self.files = self.folder_index.files()
         self.index = 0
+        self._drop_prefetched(keep=())
 
     def get_current_file_name(self):
         if not self.files:
             return ''
         return self.files[self.index]
 
+    def get_current_json_path(self):
+        if not self.files:
+            return ''
+        return os.path.splitext(self.files[self.index])[0] + '.json'
+
+    @property
+    def is_loading(self):
+        return self._load_worker is not None
+
     def load_current(self):
+        """Load the current stack synchronously (startup and folder switches)"""
         if not self.files:
             return
+        self._load_token += 1
+        self._load_wanted = False
         file = self.files[self.index]
-        volume = tifffile.imread(file)
-        if self.image_layer:
-            self.viewer.layers.remove(self.image_layer)
-        from main_app import image_pixel_size, default_colormap
-        self.image_layer = self.viewer.add_image(
-            volume, name='TiffStack',
-            colormap=default_colormap,
-            scale=image_pixel_size,
-            rendering='mip')
-        self.json_path = os.path.splitext(file)[0] + '.json'
-        self.load_callback(self.json_path)
+        self._finish_load(*self._read_stack(file, self._prefetched.pop(file, None)))
+
+    def load_current_async(self):
+        """
+        Load the current stack on a worker thread. While a load is in flight,
+        further requests only move the index; when the running load returns
+        stale it is dropped and the latest requested stack is loaded instead
+        """
+        if not self.files:
+            return
+        self._load_token += 1
+        self._load_wanted = True
+        if self._load_worker is None:
+            self._start_load()
 
     def next(self):
         if not self.files:
             return
+        self._direction = 1
         self.index = (self.index + 1) % len(self.files)
-        self.load_current()
+        self.load_current_async()
 
     def prev(self):
         if not self.files:
             return
+        self._direction = -1
         self.index = (self.index - 1 + len(self.files)) % len(self.files)
-        self.load_current()
+        self.load_current_async()
+
+    def jump_to(self, index):
+        if not self.files:
+            return
+        index %= len(self.files)
+        if index != self.index:
+            self._direction = 1 if index > self.index else -1
+        self.index = index
+        self.load_current_async()
+
+    def jump_to_file(self, text):
+        """Jump to the first stack whose file name contains text"""
+        index = self.folder_index.find(text)
+        if index is None:
+            return False
+        self.jump_to(index)
+        return True
+
+    def _start_load(self):
+        token = self._load_token
+        file = self.files[self.index]
+        # 经 _connect 连接 errored，superqt 才不会再把已处理的异常重新抛出
+        worker = create_worker(self._read_stack, file,
+                               self._prefetched.pop(file, None),
+                               _start_thread=False,
+                               _connect={'returned': lambda result: self._on_load_returned(token, result),
+                                         'errored': lambda e: self._on_load_errored(token, file, e)})
+        self._load_worker = worker
+        if self.busy_callback:
+            self.busy_callback(True)
+        worker.start()
+
+    def _on_load_returned(self, token, result):
+        self._load_worker = None
+        if token != self._load_token:
+            if self._load_wanted:
+                self._start_load()
+            elif self.busy_callback:
+                self.busy_callback(False)
+            return
+        self._load_wanted = False
+        if self.busy_callback:
+            self.busy_callback(False)
+        self._finish_load(*result)
+
+    def _on_load_errored(self, token, file, e):
+        print(f"Failed to load {file}: {e}")
+        self._load_worker = None
+        if token != self._load_token and self._load_wanted:
+            # 失败的是已过期的请求：继续加载最新请求的栈
+            self._start_load()
+            return
+        self._load_wanted = False
+        if self.busy_callback:
+            self.busy_callback(False)
+        # 回到仍在显示的栈，索引、json 路径与画面保持一致
+        if self._shown_file in self.files:
+            self.index = self.files.index(self._shown_file)
+            if self.failed_callback:
+                self.failed_callback(self.json_path)
+
+    def _read_stack(self, file, future=None):
+        """Everything that does not touch the viewer: decode, contrast statistics, JSON"""
+        with timed('read stack', self.log_timings, self.timings):
+            volume = self._read_volume(file, future)
+            stats = self._get_stats(file, volume)
+            data = self._get_display_data(file, volume)
+            json_path = os.path.splitext(file)[0] + '.json'
+            records = self._read_records(json_path)
+        return file, volume, data, stats, json_path, records
+
+    @staticmethod
+    def _read_records(json_path):
+        """
+        Arrows of a stack; a malformed or half-written JSON is moved aside to
+        <name>.json.bad, so that saving the stack later cannot overwrite it,
+        and the stack opens without arrows
+        """
+        try:
+            return read_arrow_file(json_path)
+        except (ValueError, OSError) as e:
+            # JSONDecodeError 和 UnicodeDecodeError 都是 ValueError
+            backup = json_path + '.bad'
+            try:
+                os.replace(json_path, backup)
+            except OSError:
+                backup = None
+            print(f"Warning: could not read arrows from {json_path} ({e}); "
+                  f"opening the stack without arrows"
+                  + (f", the file was moved to {backup}" if backup else ""))
+            return []
+
+    def _finish_load(self, file, volume, data, stats, json_path, records):
+        with self.transaction('display stack'):
+            self._shown_file = file
+            self.volume = volume
+            self._show_volume(data, stats)
+            self.json_path = json_path
+            self.load_callback(self.json_path, records)
+        self.prefetch()
+
+    @contextmanager
+    def transaction(self, label=None):
+        """
+        Group the layer mutations of a stack switch (image swap plus whatever the
+        load callback adds or removes) into a single repaint, optionally timed
+        """
+        with suspended_repaints(self.viewer):
+            if label is None:
+                yield self
+            else:
+                with timed(label, self.log_timings, self.timings):
+                    yield self
+
+    def prefetch(self):
+        """
+        Decode the neighbouring stacks on the worker pool so that the next
+        prev()/next() only has to hand the volume over to napari
+        """
+        if not self.files:
+            return
+        n = len(self.files)
+        offsets = [self._direction, -self._direction]
+        offsets += [self._direction * k for k in range(2, self.prefetch_depth + 1)]
+        wanted = []
+        for offset in offsets:
+            file = self.files[(self.index + offset) % n]
+            if file != self.files[self.index] and file not in wanted:
+                wanted.append(file)
+        self._drop_prefetched(keep=wanted)
+        for file in wanted:
+            if file in self._prefetched or VolumeCache.key(file) in self.cache:
+                continue
+            self._prefetched[file] = self._executor.submit(self._decode, file, True)
+        if self.registration is not None:
+            # 只配准文件夹顺序中相邻的两对（前一个 -> 当前，当前 -> 后一个）
+            for first in (self.index - 1, self.index):
+                if 0 <= first and first + 1 < n:
+                    self._schedule_registration(self.files[first], self.files[first + 1])
+
+    def get_transform(self, file_a, file_b, compute=False):
+        """
+        Drift transform from stack file_a to file_b (see registration.register):
+        registered in the background, cached in the folder index, or inverted
+        from the opposite pair; computed now if compute, else None when missing
+        """
+        transform = self._cached_transform(file_a, file_b)
+        if transform is not None:
+            return transform
+        transform = self._cached_transform(file_b, file_a)
+        if transform is not None:
+            return invert_transform(transform)
+        if compute:
+            return self._register_pair(file_a, file_b)
+        return None
+
+    def drift_between(self, file_a, file_b):
+        """
+        Drift transform from stack file_a to file_b, composed from the transforms
+        of the consecutive stacks between them (registered where missing, which
+        is slow: meant for a worker thread); None for the same stack
+        """
+        files = list(self.files)
+        i, j = files.index(file_a), files.index(file_b)
+        transform = None
+        for k in range(min(i, j), max(i, j)):
+            step = self.get_transform(files[k], files[k + 1], compute=True)
+            transform = step if transform is None else compose_transforms(transform, step)
+        if transform is None or i <= j:
+            return transform
+        return invert_transform(transform)
+
+    def register_all(self):
+        """
+        Register every consecutive pair of stacks of the folder, reusing and
+        filling the folder index cache; slow, meant for a worker thread
+        :return: list of transforms, files[i] -> files[i + 1]
+        """
+        files = list(self.files)
+        transforms = register_folder(files, self.scale, self.folder_index,
+                                     read=read_lazy if self.lazy else tifffile.imread,
+                                     **self._registration_options())
+        for file_a, file_b, transform in zip(files, files[1:], transforms):
+            self._transforms[(VolumeCache.key(file_a), VolumeCache.key(file_b))] = transform
+        return transforms
+
+    def _registration_options(self):
+        return self.registration if self.registration is not None else {}
+
+    def _cached_transform(self, file_a, file_b):
+        key = (VolumeCache.key(file_a), VolumeCache.key(file_b))
+        transform = self._transforms.get(key)
+        if transform is None:
+            transform = self.folder_index.get_registration(file_a, file_b, self._registration_options())
+            if transform is not None:
+                self._transforms[key] = transform
+        return transform
+
+    def _schedule_registration(self, file_a, file_b):
+        """Register the pair on the worker pool once the prefetch of either stack is done"""
+        key = (VolumeCache.key(file_a), VolumeCache.key(file_b))
+        if key in self._transforms or key in self._registering:
+            return
+        self._registering.add(key)
+        pending = [self._prefetched[f] for f in (file_a, file_b) if f in self._prefetched]
+        once = threading.Lock()
+
+        def submit(_=None):
+            # 等预读完成再提交，避免配准任务占满线程池等待预读
+            if all(f.done() for f in pending) and once.acquire(blocking=False):
+                self._executor.submit(self._register_in_background, key, file_a, file_b)
+
+        if not pending:
+            submit()
+        for future in pending:
+            future.add_done_callback(submit)
+
+    def _register_in_background(self, key, file_a, file_b):
+        try:
+            self._register_pair(file_a, file_b)
+        except Exception as e:
+            print(f"Registration of {os.path.basename(file_a)} -> {os.path.basename(file_b)} failed: {e}")
+        finally:
+            self._registering.discard(key)
+
+    def _register_pair(self, file_a, file_b):
+        transform = self._cached_transform(file_a, file_b)
+        if transform is None:
+            with timed('register stacks', self.log_timings, self.timings):
+                transform = register(self._read_volume(file_a), self._read_volume(file_b),
+                                     self.scale, **self._registration_options())
+            self.folder_index.put_registration(file_a, file_b, self._registration_options(), transform)
+            self._transforms[(VolumeCache.key(file_a), VolumeCache.key(file_b))] = transform
+        return transform
+
+    def _show_volume(self, data, stats):
+        """
+        Swap the data into the existing image layer when its geometry matches,
+        so callbacks, colormap, rendering mode and camera survive the switch;
+        only rebuild the layer when shape, dtype, scale or pyramid levels change
+        :param data: a volume, or a list of pyramid levels for multiscale display
+        """
+        from main_app import default_colormap
+        multiscale = isinstance(data, list)
+        levels = data if multiscale else [data]
+        signature = (multiscale, [tuple(level.shape) for level in levels],
+                     levels[0].dtype, self.scale)
+        contrast_limits = tuple(stats['contrast_limits'])
+        contrast_range = (min(stats['hist_range'][0], contrast_limits[0]),
+                          max(stats['hist_range'][1], contrast_limits[1]))
+        layer = self.image_layer
+        if (layer is not None and layer in self.viewer.layers
+                and signature == self._layer_signature):
+            layer.data = data
+            layer.contrast_limits_range = contrast_range
+            layer.contrast_limits = contrast_limits
+            return
+        if layer is not None and layer in self.viewer.layers:
+            self.viewer.layers.remove(layer)
+        self.image_layer = self.viewer.add_image(
+            data, name='TiffStack',
+            colormap=default_colormap,
+            scale=self.scale,
+            rendering='mip',
+            multiscale=multiscale,
+            contrast_limits=contrast_limits)
+        self.image_layer.contrast_limits_range = contrast_range
+        self._layer_signature = signature
+
+    def _get_display_data(self, file, volume):
+        """
+        The volume itself, or its cached pyramid when it is too large for one
+        texture; the pyramid stops at the first level that fits, the one napari
+        shows in 3D
+        """
+        if not self.multiscale_bytes or fits(volume.shape, volume.dtype.itemsize,
+                                             self.multiscale_bytes, self.max_texture_size):
+            return volume
+        if self.lazy:
+            # 懒加载时不预先读完整个栈建金字塔，由 napari 在绘制时按步长降采样
+            return volume
+        key = VolumeCache.key(file)
+        coarse = self.pyramid_cache.get(key)
+        if coarse is None:
+            coarse = build_pyramid(volume, self.scale, max_bytes=self.multiscale_bytes,
+                                   max_size=self.max_texture_size)[1:]
+            self.pyramid_cache.put(key, coarse)
+        return [volume] + coarse if coarse else volume
+
+    def _get_stats(self, file, volume):
+        key = VolumeCache.key(file)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self.folder_index.get_stats(file)
+            if stats is None or stats.get('percentiles') != list(self.contrast_percentiles):
+                stats = compute_stack_stats(volume, self.contrast_percentiles)
+                stats['percentiles'] = list(self.contrast_percentiles)
+                self.folder_index.put_stats(file, stats)
+            self._stats[key] = stats
+        return stats
+
+    def _decode(self, file, prepare=False):
+        key = VolumeCache.key(file)
+        volume = read_lazy(file) if self.lazy else tifffile.imread(file)
+        self.cache.put(key, volume)
+        if prepare:
+            self._get_stats(file, volume)
+            self._get_display_data(file, volume)
+        return volume
+
+    def _read_volume(self, file, future=None):
+        volume = self.cache.get(VolumeCache.key(file))
+        if volume is not None:
+            return volume
+        if future is not None and not future.cancelled():
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Prefetch of {file} failed, reading again: {e}")
+        return self._decode(file)
+
+    def _drop_prefetched(self, keep):
+        for file in list(self._prefetched):
+            if file not in keep or self._prefetched[file].done():
+                self._prefetched.pop(file).cancel()
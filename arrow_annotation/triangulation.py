@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+triangulation.py : Least-squares triangulation of a 3D point from k viewing rays
+
+Copyright (c) 2025 Qianxi Liang (Peking University)
+
+This software is licensed under the MIT License.
+You may obtain a copy of the License at
+
+    https://opensource.org/licenses/MIT
+
+Author: Qianxi Liang
+Affiliation: Peking University
+Date: 2025-05-29
+Description:
+    This module finds the point closest (in the least-squares sense) to any
+    number k >= 2 of rays by solving the 3x3 normal equations
+    sum_i (I - d_i d_i^T) p = sum_i (I - d_i d_i^T) o_i. Every leading axis is a
+    batch axis, so many independent triangulations are solved in one call, and
+    each result comes with its RMS distance to the rays and the condition
+    number of the system, which is large when the rays are nearly parallel.
+"""
+
+import numpy as np
+
+
+def triangulate(origins, directions, weights=None):
+    """
+    :param origins: (..., K, 3) points on the rays
+    :param directions: (..., K, 3) ray directions (need not be normalized)
+    :param weights: optional (..., K) ray weights; 0 drops a ray, so batches of
+        different ray counts can be padded to a common K
+    :return: points (..., 3), residuals (...) as the weighted RMS distance of
+        the point to its rays, and conditions (...) of the normal equations
+    """
+    origins = np.asarray(origins, dtype=float)
+    directions = np.asarray(directions, dtype=float)
+    directions = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+    if weights is None:
+        weights = np.ones(origins.shape[:-1])
+    weights = np.asarray(weights, dtype=float)
+
+    # 每条射线的投影矩阵 I - d d^T，把点投影到垂直于射线的平面上
+    projections = np.eye(3) - directions[..., :, None] * directions[..., None, :]
+    projections = projections * weights[..., None, None]
+    a = projections.sum(axis=-3)
+    b = np.einsum('...kij,...kj->...i', projections, origins)
+    # a 对称半正定：一次特征分解同时给出条件数和伪逆解，
+    # 伪逆对（近）平行的射线也有定义，是否可信由 conditions 判断
+    eigenvalues, eigenvectors = np.linalg.eigh(a)
+    largest = eigenvalues[..., -1:]
+    with np.errstate(divide='ignore'):
+        conditions = largest[..., 0] / np.maximum(eigenvalues[..., 0], 0)
+        inverse = np.where(eigenvalues > largest * 1e-12, 1 / eigenvalues, 0)
+    coefficients = np.einsum('...ji,...j->...i', eigenvectors, b) * inverse
+    points = np.einsum('...ij,...j->...i', eigenvectors, coefficients)
+
+    offsets = points[..., None, :] - origins
+    along = np.einsum('...kj,...kj->...k', offsets, directions)
+    distances = np.linalg.norm(offsets - along[..., None] * directions, axis=-1)
+    total = np.maximum(weights.sum(axis=-1), np.finfo(float).tiny)
+    residuals = np.sqrt((weights * distances ** 2).sum(axis=-1) / total)
+    return points, residuals, conditions
@@ -13,207 +13,444 @@ Author: Qianxi Liang
 Affiliation: Peking University
 Date: 2025-05-29
 Description:
-    This module defines a VectorArrow class for managing a single vector arrow,
-    and an ArrowManager class for managing a collection of vector arrows
-    in coordination with a QTableWidget for user interaction.
+    This module defines an ArrowManager class that keeps a collection of vector
+    arrows in a columnar ArrowStore and draws them into one shared napari
+    Vectors layer (per-vector colour and opacity as RGBA) in coordination with
+    a QTableView (see arrow_table) for user interaction, and a lightweight
+    VectorArrow view of a single arrow. Arrow ends and starts are kept in
+    spatial indices for picking, region queries and duplicate detection.
 """
 
 import numpy as np
-from qtpy.QtWidgets import QDoubleSpinBox, QComboBox, QPushButton
-import numpy as np
+from napari.utils.colormaps.standardize_color import transform_color
+from napari.utils.events import EmitterGroup
+from arrow_store import ArrowStore
+from arrow_table import ArrowTableModel, ArrowItemDelegate
+from batching import Batcher, suspended_repaints
+from spatial_index import SpatialIndex
+from arrow_merge import cluster_arrows, merge_clusters, duplicate_groups
+from registration import apply_transform
 import json
 import os
+from contextlib import contextmanager
+from functools import lru_cache
+
+
+def read_arrow_file(path):
+    """Parse an arrow JSON file; a missing file means no arrows"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=256)
+def is_color(name):
+    """Whether napari understands name as a colour (names, hex strings)"""
+    if not isinstance(name, str) or not name:
+        return False
+    try:
+        transform_color(name)
+    except ValueError:
+        return False
+    return True
+
+
 class VectorArrow:
-    def __init__(self, viewer, start, direction, color, width, opacity):
-        self.viewer = viewer
-        self.start = start
-        self.direction = direction
-        self.color = color
-        self.width = width
-        self.opacity = opacity
-        self.layer = self._create_layer()
-
-    def _create_layer(self):
-        data = np.array([[self.start, self.direction]])
-        layer = self.viewer.add_vectors(
-            data,
-            edge_color=self.color,
-            edge_width=self.width,
-            opacity=self.opacity,
-            vector_style='arrow',
-            name=f"arrow_{id(self)}"
-        )
-        return layer
+    """Lightweight view of one row of an ArrowManager's ArrowStore"""
+    __slots__ = ('manager', 'row')
+
+    def __init__(self, manager, row):
+        self.manager = manager
+        self.row = row
+
+    @property
+    def start(self):
+        return self.manager.store.starts[self.row].copy()
+
+    @property
+    def direction(self):
+        return self.manager.store.directions[self.row].copy()
+
+    @property
+    def end(self):
+        # 只算这一行，不构造整列 ends
+        store = self.manager.store
+        return store.starts[self.row] + store.directions[self.row]
+
+    @property
+    def color(self):
+        store = self.manager.store
+        return store.palette[store.color_ids[self.row]]
+
+    @property
+    def width(self):
+        return float(self.manager.store.widths[self.row])
+
+    @property
+    def opacity(self):
+        return float(self.manager.store.opacities[self.row])
 
     def update(self, **kwargs):
-        for k, v in kwargs.items():
-            if k == 'color':
-                self.layer.edge_color = v
-                self.color = v
-            elif k == 'width':
-                self.layer.edge_width = v
-                self.width = v
-            elif k == 'opacity':
-                self.layer.opacity = v
-                self.opacity = v
+        self.manager.update_arrows([self.row], **kwargs)
 
 
 class ArrowManager:
-    def __init__(self, viewer, table):
+    def __init__(self, viewer, table, cell_size=20.0):
+        """
+        :param cell_size: cell edge length, in physical units, of the spatial
+            indices over arrow ends and starts
+        """
         self.viewer = viewer
         self.table = table
-        self.arrows = []
+        self.store = ArrowStore()
+        # napari 的 Vectors 图层只有一个 edge_width，所以按线宽分组：
+        # 通常所有箭头同一线宽，只有一个图层
+        self.layers = {}
+        self._spare_layer = None
+        self._palette_rgba = np.empty((0, 4))
+        # 细粒度变更事件，图层和表格都只按事件更新受影响的行：
+        #   inserted / removed(first, last, widths)、changed(rows, widths, geometry)、reset()
+        self.events = EmitterGroup(source=self, inserted=None, removed=None,
+                                   changed=None, reset=None)
+        self.events.inserted.connect(self._on_rows_edited)
+        self.events.removed.connect(self._on_rows_edited)
+        self.events.changed.connect(self._on_rows_edited)
+        self.events.reset.connect(lambda event: self.render())
+        # 箭头终点/起点的空间索引（键为行号），随事件增量更新
+        self.end_index = SpatialIndex(cell_size)
+        self.start_index = SpatialIndex(cell_size)
+        self.events.inserted.connect(self._index_inserted)
+        self.events.removed.connect(self._index_removed)
+        self.events.changed.connect(self._index_changed)
+        self.events.reset.connect(self._index_reset)
+        # with manager.batch(): 期间只记录有变化，结束时发一次 reset
+        self.batch = Batcher(on_flush=self.events.reset)
+        self.model = ArrowTableModel(self, table)
+        self.delegate = ArrowItemDelegate(self, table)
+        table.setModel(self.model)
+        table.setItemDelegate(self.delegate)
+
+    def _emit(self, name, **kwargs):
+        if self.batch.active:
+            self.batch.dirty = True
+            return
+        getattr(self.events, name)(**kwargs)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Batch of arrow mutations that also holds back repaints of the viewer,
+        so the layer and the table are redrawn once at the end
+        """
+        with suspended_repaints(self.viewer), self.batch():
+            yield self
+
+    @property
+    def arrows(self):
+        return [VectorArrow(self, row) for row in range(len(self.store))]
 
     def add_arrow(self, start, direction, color='red', width=3, opacity=1.0):
-        arrow = VectorArrow(self.viewer, start, direction, color, width, opacity)
-        self.arrows.append(arrow)
-        self.refresh_table()
+        row = self.store.append(start, direction, color, width, opacity)
+        self._emit('inserted', first=row, last=row, widths={float(width)})
+
+    def add_arrows(self, ends, directions, colors='red', widths=3, opacities=1.0,
+                   confidences=np.nan):
+        """
+        Add many arrows in one store operation, one layer redraw and one table
+        insert; colors, widths, opacities and confidences may be scalars shared
+        by all arrows
+        :return: range of the rows of the new arrows
+        """
+        starts, directions, colors, widths, opacities, confidences = self._validate_arrows(
+            ends, directions, colors, widths, opacities, confidences, strict=True)
+        first = len(self.store)
+        if not len(starts):
+            return range(first, first)
+        rows = self.store.extend(starts, directions, colors, widths, opacities, confidences)
+        self._emit('inserted', first=rows.start, last=rows.stop - 1,
+                   widths=set(widths.tolist()))
+        return rows
+
+    def import_arrows(self, records, replace=False, transform=None):
+        """
+        Add arrows given as JSON-style dicts (see save_to_file)
+        :param transform: optional drift transform (see registration.apply_transform)
+            moving the arrows from the stack they were drawn on into the current one
+        """
+        ends, directions, colors, widths, opacities, confidences = self._records_to_columns(records)
+        if transform is not None and len(ends):
+            ends, directions = apply_transform(transform, ends, directions)
+        if not replace:
+            return self.add_arrows(ends, directions, colors, widths, opacities, confidences)
+        self.model.flush_edits()
+        starts, directions, colors, widths, opacities, confidences = self._validate_arrows(
+            ends, directions, colors, widths, opacities, confidences, strict=False)
+        self.store.clear()
+        self.store.extend(starts, directions, colors, widths, opacities, confidences)
+        self._emit('reset')
+        return range(len(self.store))
+
+    @staticmethod
+    def _records_to_columns(records):
+        return (np.array([item['end'] for item in records], dtype=np.float64).reshape(-1, 3),
+                np.array([item['direction'] for item in records], dtype=np.float64).reshape(-1, 3),
+                [item.get('edge_color', 'red') for item in records],
+                [item.get('edge_width', 3) for item in records],
+                [item.get('opacity', 1.0) for item in records],
+                [item.get('confidence', np.nan) for item in records])
+
+    @staticmethod
+    def _validate_arrows(ends, directions, colors, widths, opacities, confidences, strict):
+        """
+        Vectorized checks of a batch of arrows
+        :param strict: raise ValueError on invalid arrows instead of dropping them
+        :return: starts, directions, colors, widths, opacities, confidences as per-arrow columns
+        """
+        ends = np.atleast_2d(np.asarray(ends, dtype=np.float64))
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))
+        if ends.ndim != 2 or ends.shape[1] != 3 or directions.shape != ends.shape:
+            raise ValueError(f"ends and directions must both be (N, 3), got {ends.shape} and {directions.shape}")
+        n = len(ends)
+        if isinstance(colors, str):
+            colors = [colors] * n
+        elif len(colors) != n:
+            raise ValueError(f"got {len(colors)} colors for {n} arrows")
+        widths = np.broadcast_to(np.asarray(widths, dtype=np.float64), (n,))
+        opacities = np.broadcast_to(np.asarray(opacities, dtype=np.float64), (n,))
+        confidences = np.broadcast_to(np.asarray(confidences, dtype=np.float64), (n,))
+
+        # 颜色名在写入 store 之前检查：坏名字进了调色板会让之后每次绘制都出错
+        known = {c: is_color(c) for c in set(colors)}
+        valid = (np.isfinite(ends).all(axis=1) & np.isfinite(directions).all(axis=1)
+                 & (np.linalg.norm(directions, axis=1) > 0)
+                 & (widths > 0) & (opacities >= 0) & (opacities <= 1)
+                 & np.array([known[c] for c in colors], dtype=bool).reshape(n))
+        if not valid.all():
+            bad = np.flatnonzero(~valid)
+            if strict:
+                raise ValueError(f"invalid arrows at positions {bad.tolist()}: non-finite coordinates, "
+                                 f"zero-length direction, width <= 0, opacity outside [0, 1] "
+                                 f"or unknown color")
+            print(f"Skipping {len(bad)} invalid arrows at positions {bad.tolist()}")
+            ends, directions, widths, opacities = ends[valid], directions[valid], widths[valid], opacities[valid]
+            confidences = confidences[valid]
+            colors = [c for c, ok in zip(colors, valid) if ok]
+        return ends - directions, directions, colors, widths, opacities, confidences
+
+    def paste_text(self, text):
+        """
+        Add arrows from tab- or comma-separated rows laid out like the table:
+        End Z/Y/X, Dir Z/Y/X and optionally Color, Length, Width, Opacity
+        (Length is implied by the direction and ignored)
+        """
+        ends, directions, colors, widths, opacities = [], [], [], [], []
+        for line in text.splitlines():
+            fields = [f.strip() for f in line.replace(',', '\t').split('\t') if f.strip()]
+            if len(fields) < 6:
+                continue
+            try:
+                numbers = [float(f) for f in fields[:6]]
+            except ValueError:
+                continue  # 表头等非数字行
+            ends.append(numbers[:3])
+            directions.append(numbers[3:])
+            colors.append(fields[6] if len(fields) > 6 else 'red')
+            widths.append(float(fields[8]) if len(fields) > 8 else 3)
+            opacities.append(float(fields[9]) if len(fields) > 9 else 1.0)
+        if not ends:
+            return range(len(self.store), len(self.store))
+        return self.add_arrows(ends, directions, colors, widths, opacities)
+
+    def copy_text(self, rows):
+        """Tab-separated rows in the table's column order, the format paste_text reads"""
+        store = self.store
+        rows = np.asarray(rows, dtype=int)
+        colors = store.colors(rows)
+        lines = []
+        for end, direction, color, length, width, opacity in zip(
+                store.ends[rows].tolist(), store.directions[rows].tolist(), colors,
+                store.lengths[rows].tolist(), store.widths[rows].tolist(),
+                store.opacities[rows].tolist()):
+            lines.append('\t'.join([f'{v:.2f}' for v in end + direction] + [color]
+                                   + [f'{v:.2f}' for v in (length, width, opacity)]))
+        return '\n'.join(lines)
 
     def delete_arrow(self, row):
-        arrow = self.arrows.pop(row)
-        self.viewer.layers.remove(arrow.layer)
-        self.refresh_table()
+        # 删除时最后一行移到被删的位置：表现为删掉末行、再更新该行
+        self.model.flush_edits()
+        last = len(self.store) - 1
+        widths = set(self.store.widths[[row, last]].tolist())
+        moved = self.store.swap_delete(row)
+        self._emit('removed', first=last, last=last, widths=widths)
+        if moved is not None:
+            # 所在线宽分组已随 removed 重画，这里只需刷新表格和空间索引中的这一行
+            self._emit('changed', rows=np.array([row]), widths=set(), geometry=True)
+
+    def merge_duplicates(self, radius, max_angle):
+        """
+        Collapse arrows whose ends are within radius and whose directions are
+        within max_angle degrees of each other (see arrow_merge)
+        :return: list of the merged groups, as rows before merging
+        """
+        self.model.flush_edits()
+        store = self.store
+        labels = cluster_arrows(store.ends, store.directions, radius, max_angle)
+        groups = duplicate_groups(labels)
+        if not groups:
+            return []
+        keep, ends, directions = merge_clusters(store.ends, store.directions, labels)
+        colors, widths, opacities = store.colors(keep), store.widths[keep], store.opacities[keep]
+        confidences = store.confidences[keep]
+        store.clear()
+        store.extend(ends - directions, directions, colors, widths, opacities, confidences)
+        self._emit('reset')
+        return groups
 
     def clear_arrows(self):
-        for arrow in self.arrows:
-            self.viewer.layers.remove(arrow.layer)
-        self.arrows.clear()
-        self.refresh_table()
+        self.model.flush_edits()
+        self.store.clear()
+        self._emit('reset')
 
-    def refresh_table(self):
-        # from qtpy.QtWidgets import QDoubleSpinBox, QComboBox, QPushButton
-        # import numpy as np
-        self.table.blockSignals(True)
-        self.table.setRowCount(len(self.arrows))
-
-        for i, arrow in enumerate(self.arrows):
-            vec = arrow.layer.data[0]
-            start, direction = vec
-            end = start + direction
-
-            for j, val in enumerate(end):
-                spin = QDoubleSpinBox()
-                spin.setDecimals(2)
-                spin.setRange(-9999, 9999)
-                spin.setValue(val)
-                spin.setFixedWidth(60)
-                spin.valueChanged.connect(lambda _, row=i: self.update_vector_from_table(row))
-                self.table.setCellWidget(i, j, spin)
-
-            for j, val in enumerate(direction):
-                spin = QDoubleSpinBox()
-                spin.setDecimals(2)
-                spin.setRange(-9999, 9999)
-                spin.setValue(val)
-                spin.setFixedWidth(60)
-                spin.valueChanged.connect(lambda _, row=i: self.update_vector_from_table(row))
-                self.table.setCellWidget(i, 3 + j, spin)
-
-            color_box = QComboBox()
-            from main_app import available_colors
-            color_box.addItems(available_colors)
-            color_box.setCurrentText(arrow.color)
-            color_box.currentTextChanged.connect(lambda _, row=i: self.update_color_from_table(row))
-            self.table.setCellWidget(i, 6, color_box)
-
-            length_spin = QDoubleSpinBox()
-            length_spin.setDecimals(2)
-            length_spin.setRange(0.1, 1000)
-            length_spin.setValue(np.linalg.norm(direction))
-            length_spin.setFixedWidth(50)
-            length_spin.valueChanged.connect(lambda _, row=i: self.update_length_from_table(row))
-            self.table.setCellWidget(i, 7, length_spin)
-
-            width_spin = QDoubleSpinBox()
-            width_spin.setDecimals(2)
-            width_spin.setRange(0.1, 50)
-            width_spin.setValue(arrow.width)
-            width_spin.setFixedWidth(50)
-            width_spin.valueChanged.connect(lambda _, row=i: self.update_width_from_table(row))
-            self.table.setCellWidget(i, 8, width_spin)
-
-            opacity_spin = QDoubleSpinBox()
-            opacity_spin.setDecimals(2)
-            opacity_spin.setRange(0.0, 1.0)
-            opacity_spin.setSingleStep(0.05)
-            opacity_spin.setValue(arrow.opacity)
-            opacity_spin.setFixedWidth(55)
-            opacity_spin.valueChanged.connect(lambda _, row=i: self.update_opacity_from_table(row))
-            self.table.setCellWidget(i, 9, opacity_spin)
-
-            del_btn = QPushButton("Delete")
-            del_btn.setFixedWidth(60)
-            del_btn.clicked.connect(lambda _, row=i: self.delete_arrow(row))
-            self.table.setCellWidget(i, 10, del_btn)
-
-        self.table.blockSignals(False)
-
-    def update_vector_from_table(self, row):
-        # import numpy as np
-        end = np.array([self.table.cellWidget(row, j).value() for j in range(3)])
-        direction = np.array([self.table.cellWidget(row, j).value() for j in range(3, 6)])
-        start = end - direction
-        arrow = self.arrows[row]
-        arrow.layer.data = np.array([[start, direction]])
-
-    def update_color_from_table(self, row):
-        color_box = self.table.cellWidget(row, 6)
-        color = color_box.currentText()
-        self.arrows[row].update(color=color)
-
-    def update_length_from_table(self, row):
-        # import numpy as np
-        new_length = self.table.cellWidget(row, 7).value()
-        arrow = self.arrows[row]
-        vec = arrow.layer.data[0]
-        direction = vec[1] / np.linalg.norm(vec[1])
-        end = vec[0] + vec[1]
-        new_start = end - direction * new_length
-        new_vec = np.array([[new_start, direction * new_length]])
-        arrow.layer.data = new_vec
-
-    def update_width_from_table(self, row):
-        new_width = self.table.cellWidget(row, 8).value()
-        self.arrows[row].update(width=new_width)
-
-    def update_opacity_from_table(self, row):
-        new_opacity = self.table.cellWidget(row, 9).value()
-        self.arrows[row].update(opacity=new_opacity)
+    def update_arrows(self, rows, start=None, direction=None, color=None,
+                      width=None, opacity=None, length=None):
+        """Vectorized edit of any columns of the given rows, then redraw what changed"""
+        if color is not None:
+            bad = [c for c in ([color] if isinstance(color, str) else color) if not is_color(c)]
+            if bad:
+                raise ValueError(f"unknown colors {sorted(set(map(str, bad)))}")
+        widths = set(self.store.widths[rows].tolist())
+        self.store.set(rows, start=start, direction=direction, color=color,
+                       width=width, opacity=opacity)
+        if length is not None:
+            self.store.set_lengths(rows, length)
+        widths |= set(self.store.widths[rows].tolist())
+        geometry = any(v is not None for v in (start, direction, width, length))
+        self._emit('changed', rows=np.arange(len(self.store))[rows].reshape(-1),
+                   widths=widths, geometry=geometry)
+
+    def _index_rows(self, rows):
+        ends, starts = self.store.ends[rows], self.store.starts[rows]
+        for row, end, start in zip(rows, ends, starts):
+            self.end_index.insert(int(row), end)
+            self.start_index.insert(int(row), start)
+
+    def _index_inserted(self, event):
+        self._index_rows(np.arange(event.first, event.last + 1))
+
+    def _index_removed(self, event):
+        for row in range(event.first, event.last + 1):
+            self.end_index.remove(row)
+            self.start_index.remove(row)
+
+    def _index_changed(self, event):
+        if event.geometry:
+            self._index_rows(event.rows)
+
+    def _index_reset(self, event):
+        self.end_index.rebuild(self.store.ends)
+        self.start_index.rebuild(self.store.starts)
+
+    def pick_arrow(self, origin, direction, max_distance):
+        """
+        Arrow whose end or start passes closest to a viewing ray (z, y, x)
+        :return: (row, distance) or None
+        """
+        hits = [hit for hit in (self.end_index.nearest_to_ray(origin, direction, max_distance),
+                                self.start_index.nearest_to_ray(origin, direction, max_distance))
+                if hit is not None]
+        return min(hits, key=lambda hit: hit[1]) if hits else None
+
+    def find_duplicate(self, end, radius):
+        """:return: row of an existing arrow whose end is within radius of end, or None"""
+        hit = self.end_index.nearest(end, radius)
+        return None if hit is None else hit[0]
+
+    def _on_rows_edited(self, event):
+        self.render(widths=event.widths, geometry=getattr(event, 'geometry', True))
+
+    def rgba(self, rows):
+        """(N, 4) edge colours of the given rows, opacity folded into alpha"""
+        palette = self.store.palette
+        if len(self._palette_rgba) < len(palette):
+            new = [transform_color(c)[0] for c in palette[len(self._palette_rgba):]]
+            self._palette_rgba = np.vstack([self._palette_rgba, new])
+        rgba = self._palette_rgba[self.store.color_ids[rows]]
+        rgba[:, 3] *= self.store.opacities[rows]
+        return rgba
+
+    def render(self, widths=None, geometry=True):
+        """
+        Push the arrows into the shared Vectors layer(s)
+        :param widths: only redraw the layers of these edge widths (default: all)
+        :param geometry: False when only colours/opacities changed
+        """
+        all_widths = self.store.widths
+        if widths is None:
+            widths = set(self.layers) | set(all_widths.tolist())
+        rows_by_width = {w: np.flatnonzero(all_widths == w) for w in sorted(float(w) for w in widths)}
+        # 先释放空分组，再填充，这样线宽改变时能直接复用刚空出来的图层
+        for width, rows in rows_by_width.items():
+            if not len(rows) and width in self.layers:
+                self._release_layer(self.layers.pop(width))
+        for width, rows in rows_by_width.items():
+            if not len(rows):
+                continue
+            layer = self.layers.get(width)
+            new_layer = layer is None
+            if new_layer:
+                layer = self.layers[width] = self._acquire_layer(width)
+            if geometry or new_layer:
+                layer.data = self.store.vectors[rows]
+            layer.edge_color = self.rgba(rows)
+
+    def _acquire_layer(self, width):
+        layer, self._spare_layer = self._spare_layer, None
+        if layer is None:
+            layer = self.viewer.add_vectors(
+                np.empty((0, 2, 3)),
+                edge_width=width,
+                vector_style='arrow',
+                name='Arrows')
+        else:
+            layer.edge_width = width
+        return layer
+
+    def _release_layer(self, layer):
+        # 保留一个空图层给下一批箭头复用，切换栈时不用反复增删图层
+        if self._spare_layer is None:
+            layer.data = np.empty((0, 2, 3))
+            self._spare_layer = layer
+        else:
+            self.viewer.layers.remove(layer)
 
     def save_to_file(self, path):
         # import json
         # import numpy as np
-        data = []
-        for arrow in self.arrows:
-            vec = arrow.layer.data[0]
-            start, direction = vec
-            end = start + direction
-            data.append({
-                'end': end.tolist(),
-                'direction': direction.tolist(),
-                'edge_color': arrow.color,
-                'edge_width': arrow.width,
-                'length': np.linalg.norm(direction),
-                'opacity': arrow.opacity
-            })
+        store = self.store
+        data = [{
+            'end': end,
+            'direction': direction,
+            'edge_color': color,
+            'edge_width': width,
+            'length': length,
+            'opacity': opacity
+        } for end, direction, color, width, length, opacity in zip(
+            store.ends.tolist(), store.directions.tolist(), store.colors(),
+            store.widths.tolist(), store.lengths.tolist(), store.opacities.tolist())]
+        # 只有自动生成的箭头带置信度
+        for item, confidence in zip(data, store.confidences.tolist()):
+            if not np.isnan(confidence):
+                item['confidence'] = confidence
         with open(path, 'w') as f:
             json.dump(data, f, indent=2)
 
-    def load_from_file(self, path):
-        # import json
-        # import numpy as np
-        # import os
-        self.clear_arrows()
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                data = json.load(f)
-            for item in data:
-                end = np.array(item['end'])
-                direction = np.array(item['direction'])
-                self.add_arrow(
-                    start=end - direction,
-                    direction=direction,
-                    color=item.get('edge_color', 'red'),
-                    width=item.get('edge_width', 3),
-                    opacity=item.get('opacity', 1.0)
-                )
+    def load_from_file(self, path, records=None, transform=None):
+        """
+        :param records: already parsed content of path (see read_arrow_file),
+            so that the file can be read off the Qt thread
+        :param transform: optional drift correction, see import_arrows
+        """
+        if records is None:
+            records = read_arrow_file(path)
+        self.import_arrows(records, replace=True, transform=transform)